@@ -0,0 +1,133 @@
+"""
+Compares the size and the encode/decode time of pickle and the wire format on
+responses shaped like the ones the server sends.
+
+    python bench_wire.py
+"""
+import pickle
+import random
+import timeit
+
+import wire
+from models import (
+    CPUModel,
+    DataUsageModel,
+    MemoryModel,
+    ProcessModel,
+    ScannerModel,
+    SystemModel,
+)
+
+ROUNDS = 2000
+
+
+def _sample_responses():
+    rand = random.Random(0)
+
+    cpu = CPUModel(
+        usage_per_cpu=[round(rand.random(), 2) for _ in range(16)],
+        brand="Intel(R) Core(TM) i7-10750H CPU @ 2.60GHz",
+        arch="X86_64",
+        bits=64,
+        count=16,
+        logical_count=16,
+        max_frequency=5000.0,
+        current_frequency=2600.5,
+    )
+    memory = MemoryModel(usage=0.42, total=15.5, available=9.0, pretty_usage=42.0)
+    processes = ProcessModel(
+        pids=[["pid", "threads", "name", "memory(%)", "cpu(%)"]]
+        + [
+            [rand.randint(1, 40000), rand.randint(1, 64), f"process-{i}", 1.2, 0.5]
+            for i in range(10)
+        ]
+    )
+    data_usage = DataUsageModel(
+        interface_name="eth0",
+        bytes_sent=1.25,
+        bytes_recv=12.5,
+        packets_sent=1234567,
+        packets_recv=7654321,
+        dropin=0,
+        dropout=0,
+        errin=0,
+        errout=0,
+        pids_connections=[wire.KNOWN_HEADERS[1]]
+        + [
+            [rand.randint(1, 40000), "TPC", "IPv4", "ESTABLISHED"]
+            + ["192.168.0.10", rand.randint(1024, 65535), "10.0.0.1", 443]
+            for _ in range(10)
+        ],
+        interfaces=[wire.KNOWN_HEADERS[2]]
+        + [
+            [f"veth{i}", "1.5 KB/s", "20.0 KB/s", 10.0, 12.5, 0.0, 0.0]
+            for i in range(8)
+        ],
+    )
+    scanner = ScannerModel(
+        map_network=[["host", "port", "state"]]
+        + [
+            [f"192.168.0.{host}", port, "open"]
+            for host in range(1, 60)
+            for port in (22, 80, 443)
+        ],
+        progress=1.0,
+        hosts_found=59,
+        added=[],
+        removed=[],
+    )
+    system = SystemModel(
+        dirs=[["name", "type"]] + [[f"entry-{i}", "file"] for i in range(40)]
+    )
+
+    return {
+        "cpu": [cpu],
+        "memory": [memory],
+        "process": [processes],
+        "data usage": [data_usage],
+        "scanner": [scanner],
+        "system": [system],
+        "summary": [cpu, memory, memory],
+    }
+
+
+def _time(fn, *args):
+    return timeit.timeit(lambda: fn(*args), number=ROUNDS) / ROUNDS * 1e6
+
+
+def main():
+    line = "{:<12}{:>10}{:>10}{:>8}{:>14}{:>14}{:>14}{:>14}"
+    print(
+        line.format(
+            "response",
+            "pickle B",
+            "wire B",
+            "ratio",
+            "pickle enc us",
+            "wire enc us",
+            "pickle dec us",
+            "wire dec us",
+        )
+    )
+
+    for name, answers in _sample_responses().items():
+        pickled = pickle.dumps(answers)
+        encoded = wire.encode_response(answers)
+        assert wire.decode_response(encoded) == (0, answers)
+
+        print(
+            line.format(
+                name,
+                len(pickled),
+                len(encoded),
+                f"{len(pickled) / len(encoded):.1f}x",
+                f"{_time(pickle.dumps, answers):.1f}",
+                f"{_time(wire.encode_response, answers):.1f}",
+                f"{_time(pickle.loads, pickled):.1f}",
+                f"{_time(wire.decode_response, encoded):.1f}",
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
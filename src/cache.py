@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from collectors import INTERVALS
+
+# Entries kept at most, the oldest go first
+MAX_ENTRIES = 256
+
+
+class SnapshotCache:
+    """
+    Latest answer of every command and arguments, reused while it is younger
+    than the TTL of the command. Requests arriving while an answer is being
+    collected wait for that collection instead of starting their own, so the
+    collection work depends on the TTLs and not on the number of clients.
+    """
+
+    def __init__(self, ttl=None, max_entries=MAX_ENTRIES):
+        self.ttl = ttl or INTERVALS
+        self.max_entries = max_entries
+
+        self._entries = {}
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(command, args):
+        """
+        The cache key of a request, None when its arguments are not hashable.
+        """
+        key = (command, args)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def fresh(self, key, now=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        collected_at, answer = entry
+        now = time.monotonic() if now is None else now
+        if now - collected_at >= self.ttl.get(key[0], 0):
+            return None
+        return answer
+
+    async def get(self, key, collect):
+        """
+        The cached answer of `key`, or the one `collect()` returns.
+        """
+        if key is None:
+            return await collect()
+
+        answer = self.fresh(key)
+        if answer is not None:
+            return answer
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._collect(key, collect))
+            self._pending[key] = pending
+
+        # A waiter cancelled does not cancel the collection of the others
+        return await asyncio.shield(pending)
+
+    async def _collect(self, key, collect):
+        try:
+            answer = await collect()
+        finally:
+            del self._pending[key]
+
+        if answer is not None:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), answer)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+        return answer
+
+    def clear(self):
+        self._entries.clear()
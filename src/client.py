@@ -1,21 +1,418 @@
+import asyncio
+import itertools
+import logging
 import socket
+import threading
+import time
 
-from helpers import decode_response, encode_commands
+from helpers import encode_commands
+from services import Publisher
+from transport import (
+    KEEPALIVE_INTERVAL,
+    PORT,
+    SOCKET_PATH,
+    TCP,
+    TRANSPORT,
+    UDP,
+    UNIX,
+    Reassembler,
+    check_transport,
+    fragment,
+    frame,
+    read_frame,
+)
+from wire import (
+    PUSH,
+    RESPONSE,
+    decode_push,
+    decode_response,
+    encode_ack,
+    encode_subscribe,
+    message_kind,
+)
 
-BUFFER_SIZE = 1014
+logger = logging.getLogger(__name__)
 
-s = socket.socket(type=socket.SOCK_DGRAM)
+SERVER_HOST = "0.0.0.0"
+RECEIVE_BUFFER = 1024 * 1024
+# Seconds to wait for a response before sending the request again, and how
+# many times it is sent again
+REQUEST_TIMEOUT = 1
+REQUEST_RETRIES = 2
+# Default seconds between two pushes of a subscription
+PUSH_INTERVAL = 1
+SNAPSHOTS_KEPT = 8
 
 
-def get_details(screen, *args):
-    commands = [(screen, args)]
-    print(f"asking with: {(screen, args)}")
+class RequestTimeout(TimeoutError):
+    pass
 
-    s.sendto(encode_commands(commands), ("0.0.0.0", 9991))
 
-    raw_data, addr = s.recvfrom(BUFFER_SIZE)
-    if raw_data:
-        raw_response = decode_response(raw_data, commands)
-        _, details = raw_response[0]
+class Watched:
+    __slots__ = (
+        "subscription_id",
+        "commands",
+        "interval",
+        "watched_at",
+        "answers",
+        "received_at",
+        "sequence",
+        "snapshots",
+    )
 
-        return details
+    def __init__(self, subscription_id, commands, interval, now):
+        self.subscription_id = subscription_id
+        self.commands = commands
+        self.interval = interval
+        self.watched_at = now
+        self.answers = None
+        self.received_at = now
+
+        # Answers of the last pushes, the server encodes the next ones against
+        # the last acknowledged of them
+        self.sequence = 0
+        self.snapshots = {}
+
+    @property
+    def stale(self):
+        # The server pushes at least every keepalive interval
+        limit = 2 * max(self.interval, KEEPALIVE_INTERVAL)
+        return self.answers is None or time.monotonic() - self.received_at > limit
+
+    def apply(self, sequence, base_sequence, answers):
+        # Whole answers are always taken, the server may have restarted
+        if base_sequence and sequence <= self.sequence:
+            return False
+
+        self.sequence = sequence
+        self.snapshots[sequence] = self.answers = answers
+        while len(self.snapshots) > SNAPSHOTS_KEPT:
+            del self.snapshots[next(iter(self.snapshots))]
+
+        self.received_at = time.monotonic()
+        return True
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+        self.reassembler = Reassembler()
+
+    def datagram_received(self, data, addr):
+        try:
+            message = self.reassembler.feed(data, addr)
+        except ValueError as e:
+            logger.warning("Invalid datagram from %s: %r", addr, e)
+            return
+
+        if message is not None:
+            self.client.dispatch(message)
+
+    def error_received(self, exc):
+        logger.debug("%s unreachable: %r", self.client.address, exc)
+
+    def connection_lost(self, exc):
+        self.client.lost()
+
+
+class AsyncClient:
+    """
+    Talks to one server from an event loop. Requests carry an id, so responses
+    are matched whatever order they arrive in, and are sent again when no
+    response came within `timeout`, up to `retries` times. Subscriptions are
+    renewed by `renew` and their pushes applied as they arrive, the publisher
+    dispatches the screens of every push applied.
+    """
+
+    def __init__(
+        self,
+        transport=TRANSPORT,
+        address=None,
+        timeout=REQUEST_TIMEOUT,
+        retries=REQUEST_RETRIES,
+    ):
+        self.transport = check_transport(transport)
+        if address is None:
+            address = (SERVER_HOST, PORT) if transport != UNIX else SOCKET_PATH
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+
+        self.publisher = Publisher()
+        self.subscriptions = {}
+        self._by_id = {}
+        self._pending = {}
+        self._ids = itertools.count(1)
+
+        self._send = None
+        self._close = None
+        self._lock = None
+
+    async def connect(self):
+        if self._send is not None:
+            return
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self._send is not None:
+                return
+
+            loop = asyncio.get_running_loop()
+            if self.transport == UDP:
+                endpoint, _ = await loop.create_datagram_endpoint(
+                    lambda: _DatagramProtocol(self), remote_addr=self.address
+                )
+                sock = endpoint.get_extra_info("socket")
+                # Room for every fragment of a large response arriving at once
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+
+                self._send = lambda data: [endpoint.sendto(d) for d in fragment(data)]
+                self._close = endpoint.close
+                return
+
+            if self.transport == TCP:
+                reader, writer = await asyncio.open_connection(*self.address)
+                sock = writer.get_extra_info("socket")
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            else:
+                reader, writer = await asyncio.open_unix_connection(self.address)
+
+            self._send = lambda data: writer.write(frame(data))
+            self._close = writer.close
+            asyncio.ensure_future(self._read(reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                data = await read_frame(reader)
+                if data is None:
+                    break
+                self.dispatch(data)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.warning("Connection to %s lost: %r", self.address, e)
+        finally:
+            self.lost()
+
+    def lost(self):
+        """
+        Forgets the connection, the next message opens a new one.
+        """
+        close, self._send, self._close = self._close, None, None
+        if close is not None:
+            close()
+
+    def close(self):
+        self.lost()
+
+    async def send(self, data):
+        try:
+            await asyncio.wait_for(self.connect(), self.timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"No connection to {self.address}") from None
+        self._send(data)
+
+    def dispatch(self, data):
+        try:
+            kind = message_kind(data)
+            if kind == RESPONSE:
+                request_id, answers = decode_response(data)
+                future = self._pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(answers)
+            elif kind == PUSH:
+                self._apply_push(decode_push(data, self._base))
+            else:
+                logger.warning("Unexpected message kind %s", kind)
+        except ValueError as e:
+            logger.warning("Invalid message from %s: %r", self.address, e)
+
+    async def request(self, commands):
+        """
+        Answers of every `(screen, args)` in `commands`, in the same order.
+        """
+        commands = [(screen, tuple(args)) for screen, args in commands]
+        request_id = next(self._ids) & 0xFFFFFFFF
+        data = encode_commands(commands, request_id)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    await self.send(data)
+                except OSError as e:
+                    logger.warning("Request to %s not sent: %r", self.address, e)
+                    self.lost()
+                    continue
+
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                except asyncio.TimeoutError:
+                    logger.info(
+                        "Request %s to %s timed out, attempt %s of %s",
+                        request_id,
+                        self.address,
+                        attempt + 1,
+                        self.retries + 1,
+                    )
+
+            raise RequestTimeout(f"No response from {self.address}")
+        finally:
+            del self._pending[request_id]
+
+    async def subscribe(self, commands, interval=PUSH_INTERVAL):
+        """
+        The subscription to `commands`, started when it is new.
+        """
+        commands = tuple((screen, tuple(args)) for screen, args in commands)
+        watched = self.subscriptions.get(commands)
+        if watched is None:
+            subscription_id = next(self._ids) & 0xFFFFFFFF
+            watched = Watched(subscription_id, commands, interval, time.monotonic())
+            self.subscriptions[commands] = watched
+            self._by_id[subscription_id] = watched
+            await self._send_subscription(subscription_id, commands, interval)
+
+        return watched
+
+    async def renew(self, ttl=KEEPALIVE_INTERVAL):
+        """
+        Renews the subscriptions watched within the last `ttl` seconds and
+        cancels the others.
+        """
+        now = time.monotonic()
+        for commands, watched in list(self.subscriptions.items()):
+            interval = watched.interval
+            if now - watched.watched_at > ttl:
+                del self.subscriptions[commands]
+                del self._by_id[watched.subscription_id]
+                interval = 0
+
+            await self._send_subscription(watched.subscription_id, commands, interval)
+
+    async def _send_subscription(self, subscription_id, commands, interval):
+        try:
+            await self.send(encode_subscribe(subscription_id, commands, interval))
+        except OSError as e:
+            logger.warning("Subscription %s not sent: %r", subscription_id, e)
+            self.lost()
+
+    def _base(self, subscription_id, sequence):
+        watched = self._by_id.get(subscription_id)
+        return watched.snapshots.get(sequence) if watched is not None else None
+
+    def _apply_push(self, push):
+        subscription_id, sequence, base_sequence, answers = push
+        watched = self._by_id.get(subscription_id)
+        if watched is None:
+            return
+
+        if answers is None:
+            # Encoded against answers this client no longer has
+            self._ack(subscription_id, 0)
+        elif watched.apply(sequence, base_sequence, answers):
+            self._ack(subscription_id, sequence)
+            self.publisher.dispatch(tuple(screen for screen, _ in watched.commands))
+
+    def _ack(self, subscription_id, sequence):
+        if self._send is None:
+            return
+
+        try:
+            self._send(encode_ack(subscription_id, sequence))
+        except OSError as e:
+            logger.warning("Ack of %s not sent: %r", subscription_id, e)
+
+
+class BackgroundClient:
+    """
+    Runs an AsyncClient on its own thread so the render loop never waits on
+    the network. Screens get the answers last pushed right away, marked stale
+    when pushes stopped arriving, while the subscription goes on in the
+    background. Subscriptions not watched for `watch_ttl`
+    seconds are cancelled, it must outlast the longest time between two
+    frames.
+    """
+
+    def __init__(self, transport=TRANSPORT, address=None, watch_ttl=KEEPALIVE_INTERVAL):
+        self.client = AsyncClient(transport, address)
+        self.watch_ttl = watch_ttl
+
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self.loop is not None:
+                return
+
+            self.loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=self.loop.run_forever, name="client", daemon=True
+            )
+            thread.start()
+
+        self._submit(self._renew())
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            await self.client.renew(self.watch_ttl)
+
+    def _watched(self, commands, interval):
+        """
+        The subscription to `commands`, kept alive, None while it is started.
+        """
+        self._start()
+        commands = tuple((screen, tuple(args)) for screen, args in commands)
+
+        watched = self.client.subscriptions.get(commands)
+        if watched is None:
+            self._submit(self.client.subscribe(commands, interval))
+        else:
+            watched.watched_at = time.monotonic()
+        return watched
+
+    def watch(self, commands, interval=PUSH_INTERVAL):
+        """
+        The answers last pushed for `commands` and whether they are stale, None
+        until the first push arrives. The subscription lives while it is
+        watched, the publisher tells when its pushes arrive.
+        """
+        watched = self._watched(commands, interval)
+        if watched is None:
+            return None, True
+        return watched.answers, watched.stale
+
+    def prefetch(self, commands, interval=PUSH_INTERVAL):
+        """
+        Like `watch` without returning, so the answers are there when
+        `commands` are watched.
+        """
+        self._watched(commands, interval)
+
+
+client = BackgroundClient()
+
+
+def watch_many(*commands, interval=PUSH_INTERVAL):
+    """
+    Details of every `(screen, args)` pushed by the server every `interval`
+    seconds while they are watched and whether they are stale, None until the
+    first push arrives.
+    """
+    return client.watch(commands, interval)
+
+
+def watch(screen, *args, interval=PUSH_INTERVAL):
+    answers, stale = watch_many((screen, args), interval=interval)
+    return (answers[0] if answers else None), stale
+
+
+def prefetch(*commands, interval=PUSH_INTERVAL):
+    client.prefetch(commands, interval)
@@ -0,0 +1,189 @@
+import threading
+import time
+from functools import partial
+
+from constants import Screens
+from factories import (
+    CPUStrategy,
+    DataUsageStrategy,
+    DiskStrategy,
+    MemoryStrategy,
+    NetworkStrategy,
+    ProcessStrategy,
+    ScannerStrategy,
+    SystemStrategy,
+)
+from history import HistoryStore
+from models import ScannerModel
+from services import Publisher
+
+# Seconds between two samples of the same collector
+INTERVALS = {
+    Screens.CPU: 1,
+    Screens.MEMORY: 1,
+    Screens.DISK: 5,
+    Screens.NETWORK: 10,
+    Screens.SCANNER: 1,
+    Screens.PROCESS: 2,
+    Screens.DATA_USAGE: 2,
+    Screens.SYSTEM: 5,
+    Screens.FLEET: 2,
+}
+# Seconds the first read of a view waits for the first snapshot
+FIRST_SNAPSHOT_TIMEOUT = 0.2
+
+
+class NoSnapshot(LookupError):
+    """
+    Nothing was collected yet for the screen to draw.
+    """
+
+
+class Collector(threading.Thread):
+    """
+    Runs a strategy on its own thread every `interval` seconds and keeps the
+    latest model it returned, so readers never wait for psutil.
+    """
+
+    def __init__(self, command, strategy, interval):
+        super().__init__(name=f"collector-{command}", daemon=True)
+        self.command = command
+        self.strategy = strategy
+        self.interval = interval
+
+        self.publisher = Publisher()
+        self.snapshot = None
+
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+
+    def collect(self):
+        return self.strategy.execute()
+
+    def publish(self, snapshot):
+        self.snapshot = snapshot
+        self._ready.set()
+        self.publisher.dispatch(snapshot)
+
+    def run(self):
+        while not self._stopped.is_set():
+            started_at = time.monotonic()
+            try:
+                self.publish(self.collect())
+            except Exception as e:
+                print(f"{self.name} failed: {e!r}")
+
+            elapsed = time.monotonic() - started_at
+            self._stopped.wait(max(0, self.interval - elapsed))
+
+    def wait(self, timeout=None):
+        self._ready.wait(timeout)
+        return self.snapshot
+
+    def stop(self):
+        self._stopped.set()
+
+
+class ScannerCollector(Collector):
+    """
+    The scanner needs the host and sub mask to scan, which are only known once
+    the network screen asks for them.
+    """
+
+    def __init__(self, interval):
+        super().__init__(Screens.SCANNER, None, interval)
+        self.args = None
+
+    def collect(self):
+        if self.args is None:
+            return ScannerModel(
+                map_network=[], progress=0, hosts_found=0, added=[], removed=[]
+            )
+        return ScannerStrategy(self.args).execute()
+
+
+class SnapshotView:
+    """
+    Stands in for a service on the screens: every attribute is read from the
+    last snapshot published by the collector.
+    """
+
+    def __init__(self, collector):
+        self._collector = collector
+        self._waited = False
+
+    def _snapshot(self):
+        snapshot = self._collector.snapshot
+        if snapshot is None and not self._waited:
+            # Only the first read waits for the collector, and not for long: its
+            # first collection may be slow or keep failing
+            self._waited = True
+            snapshot = self._collector.wait(FIRST_SNAPSHOT_TIMEOUT)
+        if snapshot is None:
+            raise NoSnapshot(self._collector.command)
+        return snapshot
+
+    def __getattr__(self, item):
+        return getattr(self._snapshot(), item)
+
+
+class ScannerView(SnapshotView):
+    """
+    Mirrors the Scanner methods, the arguments tell the collector what to scan.
+    """
+
+    def __getattr__(self, item):
+        def method(*args):
+            self._collector.args = args
+            return getattr(self._snapshot(), item)
+
+        return method
+
+
+class SamplingEngine:
+    views = {Screens.SCANNER: ScannerView}
+
+    def __init__(self, history=None):
+        self.collectors = {}
+        self.history = history
+
+    @classmethod
+    def default(cls):
+        engine = cls(history=HistoryStore())
+        strategies = (
+            (Screens.CPU, CPUStrategy()),
+            (Screens.MEMORY, MemoryStrategy()),
+            (Screens.DISK, DiskStrategy()),
+            (Screens.NETWORK, NetworkStrategy()),
+            (Screens.PROCESS, ProcessStrategy()),
+            (Screens.DATA_USAGE, DataUsageStrategy()),
+            (Screens.SYSTEM, SystemStrategy()),
+        )
+        for command, strategy in strategies:
+            engine.register(Collector(command, strategy, INTERVALS[command]))
+        engine.register(ScannerCollector(INTERVALS[Screens.SCANNER]))
+
+        return engine
+
+    def register(self, collector):
+        self.collectors[collector.command] = collector
+
+        if self.history is not None:
+            collector.publisher.register(
+                partial(self.history.record, collector.command)
+            )
+
+    def start(self):
+        for collector in self.collectors.values():
+            collector.start()
+
+    def stop(self):
+        for collector in self.collectors.values():
+            collector.stop()
+
+    def snapshot(self, command):
+        return self.collectors[command].snapshot
+
+    def view(self, command):
+        view = self.views.get(command, SnapshotView)
+        return view(self.collectors[command])
@@ -17,3 +17,5 @@ class Screens(EnumChoices):
     SYSTEM = "SYSTEM"
 
     SUMMARY = "SUMMARY"
+
+    FLEET = "FLEET"
@@ -0,0 +1,373 @@
+import asyncio
+import errno
+import os
+import socket
+import struct
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+DISCOVERY_CONCURRENCY = 255
+DISCOVERY_TIMEOUT = 1
+# Any answer proves the host is up, a refused connection included
+DISCOVERY_PORTS = (22, 80, 443, 445)
+
+SCAN_PORTS = "22,80,443"
+SCAN_CONCURRENCY = 512
+SCAN_HOST_CONCURRENCY = 64
+SCAN_TIMEOUT = 1
+
+# The sweep and the port scan of a chunk share one budget of sockets, sized
+# from the limit on open files minus what the rest of the process may need
+RESERVED_FILES = 128
+MAX_SOCKETS = 1024
+# Running out of files says nothing about the port, the probe waits and tries
+# again, up to FILES_RETRIES times
+OUT_OF_FILES = (errno.EMFILE, errno.ENFILE)
+FILES_RETRIES = 5
+FILES_RETRY_DELAY = 0.2
+
+OPEN = "open"
+CLOSED = "closed"
+FILTERED = "filtered"
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def build_echo_request(identifier, sequence, payload=b"watcher"):
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    checksum = _checksum(header + payload)
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, identifier, sequence)
+    return header + payload
+
+
+def parse_ports(ports):
+    """
+    "22,80,8000-8010" or an iterable of ints to a sorted list of ports
+    """
+    if not isinstance(ports, str):
+        return sorted(set(ports))
+
+    result = set()
+    for part in ports.split(","):
+        start, _, end = part.strip().partition("-")
+        result.update(range(int(start), int(end or start) + 1))
+
+    return sorted(result)
+
+
+async def _iterate(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def socket_budget(reserved=RESERVED_FILES):
+    """
+    Sockets the probes sharing a budget may have open at once.
+    """
+    if resource is None:
+        return MAX_SOCKETS
+
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return MAX_SOCKETS
+    return max(1, min(soft - reserved, MAX_SOCKETS))
+
+
+async def _connect(host, port, timeout):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except ConnectionRefusedError:
+        return CLOSED
+    except asyncio.TimeoutError:
+        return FILTERED
+    except OSError as e:
+        if e.errno in OUT_OF_FILES:
+            raise
+        return FILTERED
+
+    writer.close()
+    return OPEN
+
+
+async def tcp_probe(host, port, timeout=DISCOVERY_TIMEOUT, sockets=None):
+    """
+    State of the port with nmap's names: `open` when it accepts the connection,
+    `closed` when it is refused and `filtered` when nothing answers. `sockets`
+    is the semaphore of the socket budget the probe takes its socket from.
+
+    Raises OSError when no socket could be opened after FILES_RETRIES tries.
+    """
+    for attempt in range(FILES_RETRIES):
+        try:
+            if sockets is None:
+                return await _connect(host, port, timeout)
+            async with sockets:
+                return await _connect(host, port, timeout)
+        except OSError:
+            if attempt == FILES_RETRIES - 1:
+                raise
+            await asyncio.sleep(FILES_RETRY_DELAY * (attempt + 1))
+
+
+class IcmpProbe:
+    """
+    Sends every echo request from a single socket and matches the replies by
+    source address, so a sweep never forks a `ping`.
+
+    Raw sockets need root, Linux also allows unprivileged ICMP datagram sockets
+    when `net.ipv4.ping_group_range` includes the user.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.sock = self._open()
+        self.is_raw = self.sock.type == socket.SOCK_RAW
+        self.identifier = os.getpid() & 0xFFFF
+        self.sequence = 0
+
+        self.waiters = {}
+        # Raises NotImplementedError on loops without readers, like the proactor
+        self.loop.add_reader(self.sock.fileno(), self._on_reply)
+
+    @staticmethod
+    def _open():
+        try:
+            sock = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp")
+            )
+        except PermissionError:
+            sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.getprotobyname("icmp")
+            )
+
+        sock.setblocking(False)
+        return sock
+
+    def _on_reply(self):
+        while True:
+            try:
+                data, (host, _) = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            if self.is_raw:
+                # Raw sockets also get the IP header, its size is in the IHL
+                data = data[(data[0] & 0x0F) * 4 :]
+
+            if len(data) < 8:
+                continue
+
+            icmp_type, _, _, identifier, _ = struct.unpack("!BBHHH", data[:8])
+            # The kernel rewrites the identifier of datagram sockets
+            if icmp_type != ICMP_ECHO_REPLY or (
+                self.is_raw and identifier != self.identifier
+            ):
+                continue
+
+            waiter = self.waiters.pop(host, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(True)
+
+    async def __call__(self, host, timeout=DISCOVERY_TIMEOUT):
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        waiter = self.waiters[host] = self.loop.create_future()
+
+        try:
+            self.sock.sendto(
+                build_echo_request(self.identifier, self.sequence), (host, 0)
+            )
+            return await asyncio.wait_for(waiter, timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        finally:
+            self.waiters.pop(host, None)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class Discovery:
+    """
+    Finds the hosts that are up with at most `concurrency` probes in flight,
+    all from a single process and event loop. TCP probes take their sockets
+    from `sockets`, a semaphore shared with the port scan, or from a budget of
+    their own.
+    """
+
+    def __init__(
+        self,
+        concurrency=DISCOVERY_CONCURRENCY,
+        timeout=DISCOVERY_TIMEOUT,
+        ports=DISCOVERY_PORTS,
+        method="auto",
+        sockets=None,
+    ):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.ports = ports
+        self.method = method
+        self.sockets = sockets
+
+        # Probes done in the current sweep, answered or not
+        self.probed = 0
+
+    def _icmp_probe(self, loop):
+        if self.method == "tcp":
+            return None
+
+        try:
+            return IcmpProbe(loop)
+        except (OSError, NotImplementedError):
+            if self.method == "icmp":
+                raise
+            return None
+
+    async def _tcp_probe(self, host, sockets):
+        probes = [
+            asyncio.ensure_future(tcp_probe(host, port, self.timeout, sockets))
+            for port in self.ports
+        ]
+        try:
+            for probe in asyncio.as_completed(probes):
+                if await probe != FILTERED:
+                    return True
+            return False
+        finally:
+            for probe in probes:
+                probe.cancel()
+            # The other probes may have failed too, what they raised is dropped
+            await asyncio.gather(*probes, return_exceptions=True)
+
+    async def sweep(self, hosts):
+        """
+        Yields the hosts that answered, as soon as they do.
+        """
+        icmp_probe = self._icmp_probe(asyncio.get_running_loop())
+        semaphore = asyncio.Semaphore(self.concurrency)
+        sockets = self.sockets
+        if sockets is None:
+            sockets = asyncio.Semaphore(socket_budget())
+        self.probed = 0
+
+        async def probe(host):
+            async with semaphore:
+                if icmp_probe is not None:
+                    return host, await icmp_probe(host, self.timeout)
+                return host, await self._tcp_probe(host, sockets)
+
+        tasks = [asyncio.ensure_future(probe(host)) for host in hosts]
+        try:
+            for task in asyncio.as_completed(tasks):
+                host, is_up = await task
+                self.probed += 1
+                if is_up:
+                    yield host
+        finally:
+            for task in tasks:
+                task.cancel()
+            if icmp_probe is not None:
+                icmp_probe.close()
+
+    async def _collect(self, hosts):
+        return [host async for host in self.sweep(hosts)]
+
+    def run(self, hosts):
+        return asyncio.run(self._collect(hosts))
+
+
+class PortScanner:
+    """
+    TCP connect scanner, `concurrency` bounds the connections in flight overall
+    and `host_concurrency` the ones against a single host. Like the discovery,
+    it takes its sockets from `sockets` or from a budget of its own.
+    """
+
+    def __init__(
+        self,
+        ports=SCAN_PORTS,
+        concurrency=SCAN_CONCURRENCY,
+        host_concurrency=SCAN_HOST_CONCURRENCY,
+        timeout=SCAN_TIMEOUT,
+        states=None,
+        sockets=None,
+    ):
+        self.ports = parse_ports(ports)
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.timeout = timeout
+        # Only these states are reported, all of them when None
+        self.states = states
+        self.sockets = sockets
+
+    async def scan(self, hosts):
+        """
+        Yields `(host, port, state)` as soon as each probe ends. `hosts` can be
+        an async iterable, like `Discovery.sweep`, so ports are scanned while
+        the sweep is still running.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        sockets = self.sockets
+        if sockets is None:
+            sockets = asyncio.Semaphore(socket_budget())
+        results = asyncio.Queue()
+        tasks = set()
+
+        async def probe(host, port, host_semaphore):
+            async with host_semaphore, semaphore:
+                state = await tcp_probe(host, port, self.timeout, sockets)
+            await results.put((host, port, state))
+
+        async def feed():
+            try:
+                async for host in _iterate(hosts):
+                    host_semaphore = asyncio.Semaphore(self.host_concurrency)
+                    for port in self.ports:
+                        tasks.add(
+                            asyncio.ensure_future(probe(host, port, host_semaphore))
+                        )
+                if tasks:
+                    await asyncio.gather(*tasks)
+            finally:
+                await results.put(None)
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                if self.states is None or result[2] in self.states:
+                    yield result
+
+            # A sweep or a probe that failed fails the scan, rather than leave
+            # the hosts it did not get to look down
+            await feeder
+        finally:
+            feeder.cancel()
+            for task in tasks:
+                task.cancel()
+
+    async def _collect(self, hosts):
+        return [result async for result in self.scan(hosts)]
+
+    def run(self, hosts):
+        return asyncio.run(self._collect(hosts))
@@ -52,7 +52,7 @@ class MethodServiceStrategy(BaseServiceStrategy, ABC):
         service = self.service
 
         for i in list(self.model.__annotations__.keys()):
-            result[i] = getattr(service, i)(self.args)
+            result[i] = getattr(service, i)(*self.args)
 
         return self.model(**result)
 
@@ -81,8 +81,9 @@ class ScannerStrategy(MethodServiceStrategy):
     service = Scanner()
     model = ScannerModel
 
-    def __init__(self, base_host):
-        self.args = base_host[0]
+    def __init__(self, args):
+        # Host and sub mask of the network to scan
+        self.args = args
 
 
 class ProcessStrategy(BaseServiceStrategy):
@@ -0,0 +1,455 @@
+"""
+Watches many servers at once: every refresh asks all of them concurrently from a
+single event loop, so it takes one round trip whatever the size of the fleet,
+and a host that does not answer only marks its own row. Relays are asked for
+the hosts they watch, so a fleet can be split between them.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import threading
+import time
+from dataclasses import replace
+from operator import attrgetter, itemgetter
+from statistics import fmean
+
+from client import AsyncClient, RequestTimeout
+from collectors import INTERVALS
+from constants import Screens
+from history import percentile
+from models import FleetModel
+from transport import PORT, TRANSPORT, UNIX
+
+logger = logging.getLogger(__name__)
+
+# Servers of the fleet as "host[:port]" separated by commas, or socket paths
+FLEET = os.environ.get("WATCHER_FLEET", "")
+# Relays of the fleet, given the same way
+RELAYS = os.environ.get("WATCHER_RELAYS", "")
+FLEET_COMMANDS = ((Screens.CPU, ()), (Screens.MEMORY, ()), (Screens.DISK, ()))
+RELAY_COMMANDS = ((Screens.FLEET, ("rows",)),)
+# A slow host is given up on quickly, the next refresh asks it again
+FLEET_TIMEOUT = 1
+FLEET_RETRIES = 0
+FLEET_INTERVAL = INTERVALS[Screens.FLEET]
+# Busiest hosts in the rollups
+TOP_HOSTS = 5
+ROLLUP_PERCENTILE = 95
+
+SORT_KEYS = ("cpu", "memory", "disk", "host")
+FLEET_HEADER = ["host", "cpu", "memory", "disk", "status"]
+HOSTS_HEADER = [
+    "host",
+    "cpu",
+    "memory",
+    "disk",
+    "memory total",
+    "memory available",
+    "disk total",
+    "disk available",
+    "status",
+]
+
+
+def parse_servers(value, transport=TRANSPORT):
+    servers = []
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        if transport == UNIX:
+            servers.append(item)
+            continue
+
+        host, _, port = item.rpartition(":") if ":" in item else (item, "", "")
+        servers.append((host, int(port) if port else PORT))
+
+    return servers
+
+
+def server_name(server):
+    return server if isinstance(server, str) else f"{server[0]}:{server[1]}"
+
+
+def _summary(values):
+    """
+    Average, percentile and max of `values`, None when there are none.
+    """
+    if not values:
+        return None
+    return [fmean(values), percentile(values, ROLLUP_PERCENTILE), max(values)]
+
+
+def _combine(values, parts):
+    """
+    The summary of `values` together with the `(count, summary)` of other
+    parts of the fleet. The percentile of the whole is at most the largest of
+    the parts' ones, which stands for it.
+    """
+    parts = [(count, summary) for count, summary in parts if count and summary]
+    if values:
+        parts.append((len(values), _summary(values)))
+    if not parts:
+        return None
+
+    total = sum(count for count, _ in parts)
+    return [
+        sum(count * summary[0] for count, summary in parts) / total,
+        max(summary[1] for _, summary in parts),
+        max(summary[2] for _, summary in parts),
+    ]
+
+
+def _unanswered(rollup):
+    """
+    The rollup of a relay that stopped answering: its hosts, none answering.
+    """
+    return replace(
+        rollup,
+        answering=0,
+        cpu=None,
+        memory=None,
+        disk=None,
+        memory_total=0,
+        memory_available=0,
+        disk_total=0,
+        disk_available=0,
+        top_cpu=[["host", "cpu"]],
+        top_memory=[["host", "memory"]],
+        rows=None,
+    )
+
+
+class HostStatus:
+    __slots__ = (
+        "name",
+        "cpu",
+        "memory",
+        "disk",
+        "memory_total",
+        "memory_available",
+        "disk_total",
+        "disk_available",
+        "updated_at",
+        "error",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.cpu = None
+        self.memory = None
+        self.disk = None
+        self.memory_total = None
+        self.memory_available = None
+        self.disk_total = None
+        self.disk_available = None
+        self.updated_at = None
+        self.error = None
+
+    @property
+    def answering(self):
+        return self.updated_at is not None and not self.error
+
+    def update(self, answers, now):
+        cpu, memory, disk = answers
+        self.cpu = fmean(cpu.usage_per_cpu) if cpu and cpu.usage_per_cpu else None
+        self.memory = memory.usage if memory else None
+        self.memory_total = memory.total if memory else None
+        self.memory_available = memory.available if memory else None
+        self.disk = disk.usage if disk else None
+        self.disk_total = disk.total if disk else None
+        self.disk_available = disk.available if disk else None
+        self.updated_at = now
+        self.error = None
+
+    def update_row(self, row, now):
+        """
+        Takes the values of the row a relay sent for this host.
+        """
+        (
+            _,
+            self.cpu,
+            self.memory,
+            self.disk,
+            self.memory_total,
+            self.memory_available,
+            self.disk_total,
+            self.disk_available,
+            status,
+        ) = row
+        if status == "ok":
+            self.updated_at = now
+            self.error = None
+        elif status != "waiting":
+            self.error = status
+
+    def status(self, now):
+        if self.updated_at is None:
+            return self.error or "waiting"
+        if self.error:
+            return f"{self.error}, {now - self.updated_at:.0f}s ago"
+        return "ok"
+
+    def row(self, now):
+        usages = (self.cpu, self.memory, self.disk)
+        return (
+            [self.name]
+            + ["-" if usage is None else f"{usage:.0%}" for usage in usages]
+            + [self.status(now)]
+        )
+
+    def relay_row(self):
+        return [
+            self.name,
+            self.cpu,
+            self.memory,
+            self.disk,
+            self.memory_total,
+            self.memory_available,
+            self.disk_total,
+            self.disk_available,
+            "ok" if self.answering else self.error or "waiting",
+        ]
+
+
+class Fleet:
+    """
+    Latest CPU, memory and disk usage of every server, refreshed by asking all
+    of them at once. The hosts of a relay are named after it, as "relay/host".
+
+    Relays are asked for the rows of all their hosts when `relay_rows` is None,
+    which relays watching relays need. Otherwise they are asked for their
+    rollup and only the `relay_rows` first rows by `sort`, so a dashboard gets
+    the same amount of data however many hosts are behind them.
+    """
+
+    def __init__(
+        self,
+        servers,
+        relays=(),
+        transport=TRANSPORT,
+        commands=FLEET_COMMANDS,
+        timeout=FLEET_TIMEOUT,
+        retries=FLEET_RETRIES,
+        relay_rows=None,
+    ):
+        self.commands = commands
+        self.clients = {
+            server_name(server): AsyncClient(transport, server, timeout, retries)
+            for server in servers
+        }
+        self.hosts = {name: HostStatus(name) for name in self.clients}
+        self.relays = {
+            server_name(relay): AsyncClient(transport, relay, timeout, retries)
+            for relay in relays
+        }
+        self.relay_rows = relay_rows
+        self.sort = SORT_KEYS[0]
+
+        # With `relay_rows`, the last rollup of every relay and the hosts of
+        # the rows they sent, which are only drawn
+        self.rollups = {}
+        self.relayed = {}
+
+    def __len__(self):
+        return len(self.hosts) + sum(rollup.hosts for rollup in self.rollups.values())
+
+    async def _request(self, name, client, commands):
+        """
+        The answers of `client`, or the error to mark its hosts with.
+        """
+        try:
+            return await client.request(commands), None
+        except RequestTimeout:
+            return None, "timeout"
+        except OSError as e:
+            logger.warning("%s unreachable: %r", name, e)
+            return None, "unreachable"
+
+    async def _refresh_host(self, name, client):
+        answers, error = await self._request(name, client, self.commands)
+        if error:
+            self.hosts[name].error = error
+        else:
+            self.hosts[name].update(answers, time.monotonic())
+
+    def _relay_commands(self):
+        if self.relay_rows is None:
+            return RELAY_COMMANDS
+        return ((Screens.FLEET, ("rows", self.sort, self.relay_rows)),)
+
+    async def _refresh_relay(self, name, client):
+        answers, error = await self._request(name, client, self._relay_commands())
+        rollup = answers[0] if answers else None
+        prefix = f"{name}/"
+        if rollup is None or rollup.rows is None:
+            for host, status in [*self.hosts.items(), *self.relayed.items()]:
+                if host.startswith(prefix):
+                    status.error = error or "no fleet"
+            if name in self.rollups:
+                self.rollups = {**self.rollups, name: _unanswered(self.rollups[name])}
+            return
+
+        # Drawing iterates the hosts from another thread, so they are swapped
+        # for new dicts rather than changed while it goes through them
+        if self.relay_rows is None:
+            self.hosts = self._update_rows(self.hosts, prefix, rollup.rows, drop=False)
+        else:
+            self.relayed = self._update_rows(
+                self.relayed, prefix, rollup.rows, drop=True
+            )
+            self.rollups = {**self.rollups, name: rollup}
+
+    @staticmethod
+    def _update_rows(hosts, prefix, rows, drop):
+        """
+        `hosts` with the statuses of the `rows` a relay sent, the others of the
+        relay are dropped when `drop`.
+        """
+        now = time.monotonic()
+        statuses = {}
+        for row in rows[1:]:
+            host = f"{prefix}{row[0]}"
+            status = hosts.get(host) or HostStatus(host)
+            status.update_row(row, now)
+            statuses[host] = status
+
+        if drop:
+            hosts = {
+                host: status
+                for host, status in hosts.items()
+                if not host.startswith(prefix)
+            }
+        return {**hosts, **statuses}
+
+    async def refresh(self):
+        await asyncio.gather(
+            *(
+                self._refresh_host(name, client)
+                for name, client in self.clients.items()
+            ),
+            *(
+                self._refresh_relay(name, client)
+                for name, client in self.relays.items()
+            ),
+        )
+        return self.hosts
+
+    async def run(self, interval=FLEET_INTERVAL):
+        """
+        Refreshes the fleet every `interval` seconds, until cancelled.
+        """
+        while True:
+            started_at = time.monotonic()
+            await self.refresh()
+            await asyncio.sleep(max(0, interval - (time.monotonic() - started_at)))
+
+    @property
+    def answering(self):
+        return sum(1 for status in self.hosts.values() if status.answering) + sum(
+            rollup.answering for rollup in self.rollups.values()
+        )
+
+    def sorted(self, key="cpu"):
+        """
+        Hosts by name, or the busiest first by the `key` usage, those without
+        it last. The rows of relays sent only some of them.
+        """
+        hosts = [*self.hosts.values(), *self.relayed.values()]
+        if key == "host":
+            return sorted(hosts, key=lambda status: status.name)
+
+        return sorted(
+            hosts,
+            key=lambda status: (
+                getattr(status, key) is None,
+                -(getattr(status, key) or 0),
+                status.name,
+            ),
+        )
+
+    def rows(self, key="cpu", limit=None):
+        now = time.monotonic()
+        return [FLEET_HEADER] + [status.row(now) for status in self.sorted(key)[:limit]]
+
+    def rollup(self, top=TOP_HOSTS, rows=False, key=None, limit=None):
+        """
+        Usage of the answering hosts summed up, with the `top` busiest ones.
+        When `rows`, also the row of every host so another relay can use them,
+        or of the `limit` first by `key` when given.
+        """
+        statuses = list(self.hosts.values())
+        hosts = [status for status in statuses if status.answering]
+        rollups = list(self.rollups.items())
+
+        def values(key):
+            return [value for value in map(attrgetter(key), hosts) if value is not None]
+
+        def summary(key):
+            parts = [(rollup.answering, getattr(rollup, key)) for _, rollup in rollups]
+            return _combine(values(key), parts)
+
+        def total(key):
+            relayed = sum(getattr(rollup, key) for _, rollup in rollups)
+            return round(sum(values(key)) + relayed, 2)
+
+        def busiest(key):
+            candidates = [
+                (status.name, getattr(status, key))
+                for status in hosts
+                if getattr(status, key) is not None
+            ]
+            candidates += [
+                (f"{name}/{host}", value)
+                for name, rollup in rollups
+                for host, value in getattr(rollup, f"top_{key}")[1:]
+            ]
+            busiest = heapq.nlargest(top, candidates, key=itemgetter(1))
+            return [["host", key]] + list(map(list, busiest))
+
+        if not rows:
+            host_rows = None
+        elif key is None:
+            host_rows = [HOSTS_HEADER] + [status.relay_row() for status in statuses]
+        else:
+            host_rows = [HOSTS_HEADER] + [
+                status.relay_row() for status in self.sorted(key)[:limit]
+            ]
+
+        return FleetModel(
+            hosts=len(statuses) + sum(rollup.hosts for _, rollup in rollups),
+            answering=len(hosts) + sum(rollup.answering for _, rollup in rollups),
+            cpu=summary("cpu"),
+            memory=summary("memory"),
+            disk=summary("disk"),
+            memory_total=total("memory_total"),
+            memory_available=total("memory_available"),
+            disk_total=total("disk_total"),
+            disk_available=total("disk_available"),
+            top_cpu=busiest("cpu"),
+            top_memory=busiest("memory"),
+            rows=host_rows,
+        )
+
+
+class BackgroundFleet(Fleet):
+    """
+    Refreshes the fleet every `interval` seconds on its own thread, so drawing
+    it never waits on the network.
+    """
+
+    def __init__(self, servers, relays=(), interval=FLEET_INTERVAL, **kwargs):
+        super().__init__(servers, relays, **kwargs)
+        self.interval = interval
+
+        self.loop = None
+
+    def start(self):
+        if self.loop is not None:
+            return
+
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(
+            target=self.loop.run_forever, name="fleet", daemon=True
+        )
+        thread.start()
+
+        asyncio.run_coroutine_threadsafe(self.run(self.interval), self.loop)
@@ -1,11 +1,11 @@
-import multiprocessing
 import os
-import pickle
 import time
 from functools import wraps
 
 import pygame
 
+import wire
+
 
 def handle_quit(event):
     pressed_keys = pygame.key.get_pressed()
@@ -33,36 +33,6 @@ def scheduler_timer(f):
     return wrap
 
 
-def threader(target, jobs, pool_size):
-    results_list = list()
-
-    jobs_queue = multiprocessing.Queue()
-    results_queue = multiprocessing.Queue()
-
-    pool = [
-        multiprocessing.Process(target=target, args=(jobs_queue, results_queue))
-        for _ in range(pool_size)
-    ]
-
-    for p in pool:
-        p.start()
-
-    for i in jobs:
-        jobs_queue.put(i)
-
-    for _ in pool:
-        jobs_queue.put(None)
-
-    for p in pool:
-        p.join()
-
-    while not results_queue.empty():
-        result = results_queue.get()
-        results_list.append(result)
-
-    return results_list
-
-
 def clean_terminal():
     os.system("cls") if "nt" in os.name else os.system("clear")
 
@@ -74,31 +44,30 @@ def prettify(value):
     return round(value / (1024 * 1024 * 1024), 2)
 
 
-def encode_commands(message):
-    return pickle.dumps(message)
+def prettify_rate(value):
+    """
+    bytes per second to the largest unit that keeps it above 1
+    """
+    for unit in ("B/s", "KB/s", "MB/s", "GB/s"):
+        if value < 1024:
+            break
+        value /= 1024
 
+    return f"{round(value, 1)} {unit}"
 
-def decode_message(raw_message):
-    commands = []
-    for command, args in pickle.loads(raw_message):
-        commands.append((command, args))
 
-    return commands
+def encode_commands(message, request_id=0):
+    return wire.encode_request(message, request_id)
 
 
-def encode_message(raw_message):
-    return pickle.dumps(raw_message)
+def decode_message(raw_message):
+    return wire.decode_request(raw_message)
 
 
-def decode_response(raw_messages, commands):
-    results = []
+def encode_message(raw_message, request_id=0):
+    return wire.encode_response(raw_message, request_id)
 
-    messages = pickle.loads(raw_messages)
-    for raw_message, command in zip(messages, commands):
-        if isinstance(raw_message, str):
-            message = raw_message.decode()
-        else:
-            message = raw_message
 
-        results.append((command, message))
-    return results
+def decode_response(raw_messages, commands):
+    _, messages = wire.decode_response(raw_messages)
+    return list(zip(commands, messages))
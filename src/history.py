@@ -0,0 +1,160 @@
+import threading
+import time
+from array import array
+from statistics import fmean
+
+from constants import Screens
+from services import NetworkService
+
+# Samples kept per metric, at the collectors' intervals this is 10 minutes of
+# CPU and memory, 20 of data usage and 50 of disk
+HISTORY_SIZE = 600
+
+
+class RingBuffer:
+    """
+    Fixed size history of a set of numeric columns.
+
+    Every column is a preallocated array of doubles, so memory use only depends
+    on `size` and the number of columns, never on how long it has been running.
+    """
+
+    def __init__(self, columns, size=HISTORY_SIZE):
+        self.columns = {column: idx for idx, column in enumerate(columns)}
+        self.size = size
+
+        self._timestamps = array("d", bytes(8 * size))
+        self._values = [array("d", bytes(8 * size)) for _ in self.columns]
+        self._position = 0
+        self._count = 0
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values, timestamp=None):
+        with self._lock:
+            self._timestamps[self._position] = timestamp or time.time()
+            for column, value in zip(self._values, values):
+                column[self._position] = value
+
+            self._position = (self._position + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def _ordered(self, data, samples):
+        samples = self._count if samples is None else min(samples, self._count)
+        start = (self._position - samples) % self.size
+
+        if start + samples <= self.size:
+            return data[start : start + samples]
+        return data[start:] + data[: self._position]
+
+    def window(self, column, samples=None):
+        """
+        Last `samples` values of a column, oldest first.
+        """
+        with self._lock:
+            return self._ordered(self._values[self.columns[column]], samples)
+
+    def timestamps(self, samples=None):
+        with self._lock:
+            return self._ordered(self._timestamps, samples)
+
+    def min(self, column, samples=None):
+        values = self.window(column, samples)
+        return min(values) if values else None
+
+    def max(self, column, samples=None):
+        values = self.window(column, samples)
+        return max(values) if values else None
+
+    def avg(self, column, samples=None):
+        values = self.window(column, samples)
+        return fmean(values) if values else None
+
+    def percentile(self, column, q, samples=None):
+        return percentile(self.window(column, samples), q)
+
+
+def percentile(values, q):
+    """
+    Linear interpolation between the closest ranks, `q` goes from 0 to 100.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+class HistoryStore:
+    """
+    Keeps a RingBuffer per screen, fed with the snapshots the collectors publish.
+    Data usage is kept as the rates of its interface measured by `throughput`,
+    the counters in its snapshots only ever grow.
+    """
+
+    def __init__(self, size=HISTORY_SIZE, throughput=None):
+        self.size = size
+        self.throughput = (
+            NetworkService.throughput if throughput is None else throughput
+        )
+        self.buffers = {}
+
+    @staticmethod
+    def _cpu(snapshot):
+        usages = list(snapshot.usage_per_cpu)
+        columns = ["usage", "frequency", *(f"cpu{i}" for i in range(len(usages)))]
+        values = [fmean(usages) if usages else 0, snapshot.current_frequency or 0]
+        return columns, values + usages
+
+    @staticmethod
+    def _usage(snapshot):
+        return ["usage", "available"], [snapshot.usage, snapshot.available]
+
+    def _data_usage(self, snapshot):
+        # The first sample has nothing to measure rates against
+        first = self.throughput.sampled_at is None
+        self.throughput.sample()
+        if first:
+            return None
+
+        try:
+            rates = self.throughput.rates(snapshot.interface_name)
+        except KeyError:
+            return None
+
+        columns = ["bytes_sent", "bytes_recv", "packets_sent", "packets_recv"]
+        return columns, [rates[column] for column in columns]
+
+    @property
+    def metrics(self):
+        return {
+            Screens.CPU: self._cpu,
+            Screens.MEMORY: self._usage,
+            Screens.DISK: self._usage,
+            Screens.DATA_USAGE: self._data_usage,
+        }
+
+    def record(self, command, snapshot):
+        metric = self.metrics.get(command)
+        if metric is None:
+            return
+
+        sample = metric(snapshot)
+        if sample is None:
+            return
+
+        columns, values = sample
+        buffer = self.buffers.get(command)
+        if buffer is None:
+            buffer = self.buffers[command] = RingBuffer(columns, self.size)
+
+        buffer.append(values)
+
+    def get(self, command):
+        return self.buffers.get(command)
@@ -0,0 +1,104 @@
+import ipaddress
+
+# Hosts that have not answered for this long are dropped
+HOST_TTL = 15 * 60
+# Known hosts are rechecked after MIN_RECHECK, twice as late every time nothing
+# changed, up to MAX_RECHECK
+MIN_RECHECK = 60
+MAX_RECHECK = 16 * 60
+
+
+class HostEntry:
+    __slots__ = ("host", "ports", "first_seen", "last_seen", "interval", "next_check")
+
+    def __init__(self, host, now):
+        self.host = host
+        self.ports = {}
+        self.first_seen = now
+        self.last_seen = now
+        self.interval = MIN_RECHECK
+        self.next_check = now + MIN_RECHECK
+
+
+class Inventory:
+    """
+    Hosts and the state of their ports keyed by address, with the time they
+    were first and last seen. A scan cycle updates it through `seen` and
+    `end_cycle`, which also keeps the hosts added and removed by that cycle.
+    """
+
+    def __init__(self, ttl=HOST_TTL, min_recheck=MIN_RECHECK, max_recheck=MAX_RECHECK):
+        self.ttl = ttl
+        self.min_recheck = min_recheck
+        self.max_recheck = max_recheck
+
+        self.hosts = {}
+        self.added = []
+        self.removed = []
+
+        self._added = set()
+        self._changed = set()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __contains__(self, host):
+        return host in self.hosts
+
+    def clear(self):
+        self.hosts.clear()
+        self.added, self.removed = [], []
+        self._added.clear()
+        self._changed.clear()
+
+    def seen(self, host, port, state, now):
+        entry = self.hosts.get(host)
+        if entry is None:
+            entry = self.hosts[host] = HostEntry(host, now)
+            self._added.add(host)
+
+        if entry.ports.get(port) != state:
+            entry.ports[port] = state
+            self._changed.add(host)
+
+        entry.last_seen = now
+
+    def due(self, now):
+        return [entry.host for entry in self.hosts.values() if entry.next_check <= now]
+
+    def end_cycle(self, checked, started_at, now):
+        """
+        Schedules the next check of the `checked` hosts and drops the expired
+        ones. Hosts that changed, or did not answer since the cycle started at
+        `started_at`, are checked again soon.
+        """
+        for host in checked:
+            entry = self.hosts.get(host)
+            if entry is None:
+                continue
+
+            if host in self._changed or entry.last_seen < started_at:
+                entry.interval = self.min_recheck
+            else:
+                entry.interval = min(entry.interval * 2, self.max_recheck)
+            entry.next_check = now + entry.interval
+
+        expired = [h for h, e in self.hosts.items() if now - e.last_seen > self.ttl]
+        for host in expired:
+            del self.hosts[host]
+
+        self.added, self.removed = sorted(self._added, key=_sort_key), expired
+        self._added.clear()
+        self._changed.clear()
+
+    def rows(self):
+        rows = []
+        for host in sorted(self.hosts, key=_sort_key):
+            for port, state in sorted(self.hosts[host].ports.items()):
+                rows.append([host, port, state])
+
+        return rows
+
+
+def _sort_key(host):
+    return ipaddress.ip_address(host)
@@ -1,7 +1,12 @@
+import math
+import time
 from abc import ABC, abstractmethod
+from functools import lru_cache, partial
 
 import pygame
 
+from collectors import INTERVALS, NoSnapshot, SamplingEngine
+from constants import Screens
 from helpers import clean_terminal, handle_quit
 from scanner import Scanner
 from services import (
@@ -25,13 +30,29 @@ WIDTH = 800
 MARGIN_Y = 5
 MARGIN_X = 35
 
+HISTORY_HEIGHT = 150
+
 # Font Configuration
 FONT_SIZE = 13
 FONT_STYLE = "freesansbold.ttf"
+# Rendered texts kept, the least recently drawn go first
+TEXT_CACHE_ENTRIES = 1024
+TEXT_CACHE_BYTES = 8 * 1024 * 1024
+
+# Regions updated one by one, more are updated as a single one
+MAX_DIRTY_RECTS = 32
 
 # Game Speed
 FPS = 10
 HITS_TO_INCREASE_SPEED = 10
+# Seconds between two frames while the window is hidden or not focused
+IDLE_INTERVAL = 5
+# From this version SDL sleeps in the video driver while it waits for events,
+# older ones look for them every millisecond
+WAITS_FOR_EVENTS = pygame.get_sdl_version() >= (2, 0, 16)
+
+# Posted by the threads receiving the data of the screens when there is new one
+SNAPSHOT_EVENT = pygame.USEREVENT + 1
 
 # Colors
 WHITE = (255, 255, 255)
@@ -46,6 +67,221 @@ screen = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption("Watcher")
 
 
+@lru_cache(maxsize=None)
+def get_font(style=FONT_STYLE, size=FONT_SIZE):
+    """
+    The font of every style and size is loaded once for the whole process.
+    """
+    return pygame.font.Font(style, size)
+
+
+class TextCache:
+    """
+    Surfaces of the texts drawn lately, so the labels drawn on every frame are
+    rendered once. The least recently drawn go first when there are more than
+    `max_entries` of them or they take more than `max_bytes`.
+    """
+
+    def __init__(self, max_entries=TEXT_CACHE_ENTRIES, max_bytes=TEXT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = {}
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _size(surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def render(self, text, color=WHITE, size=FONT_SIZE, style=FONT_STYLE):
+        key = (text, color, size, style)
+        surface = self._entries.pop(key, None)
+        if surface is None:
+            surface = get_font(style, size).render(text, True, color)
+            self._bytes += self._size(surface)
+        self._entries[key] = surface
+
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            self._bytes -= self._size(self._entries.pop(next(iter(self._entries))))
+
+        return surface
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+texts = TextCache()
+
+
+class Renderer:
+    """
+    Keeps what every widget drew on the last frame, keyed by its rect and the
+    values it showed. A frame only draws again the regions where a widget
+    changed, moved or is gone, and tells which ones so only them are sent to
+    the display.
+    """
+
+    def __init__(self, surface, background=BLACK):
+        self.surface = surface
+        self.background = background
+
+        self._drawn = {}
+        self._frame = {}
+
+    def add(self, rect, signature, draw):
+        """
+        Queues `draw` of the widget covering `rect`, its `signature` changes
+        with whatever it shows.
+        """
+        self._frame[(tuple(rect), signature)] = (rect, draw)
+
+    def discard(self):
+        """
+        Forgets the widgets queued since the last frame.
+        """
+        self._frame = {}
+
+    def invalidate(self):
+        """
+        Draws everything again on the next frame, after the window was covered.
+        """
+        self._drawn = {}
+
+    def render(self):
+        """
+        Draws the widgets queued since the last call where they changed and
+        returns the regions drawn.
+        """
+        drawn, frame = self._drawn, self._frame
+        self._drawn, self._frame = frame, {}
+
+        dirty = [
+            pygame.Rect(rect) for key, (rect, _) in drawn.items() if key not in frame
+        ]
+        dirty += [
+            pygame.Rect(rect) for key, (rect, _) in frame.items() if key not in drawn
+        ]
+        if len(dirty) > MAX_DIRTY_RECTS:
+            dirty = [dirty[0].unionall(dirty[1:])]
+
+        for area in dirty:
+            self.surface.set_clip(area)
+            self.surface.fill(self.background)
+            for rect, draw in frame.values():
+                if area.colliderect(rect):
+                    draw()
+        self.surface.set_clip(None)
+
+        return dirty
+
+
+renderer = Renderer(screen)
+
+
+def post_snapshot(*commands):
+    """
+    Wakes the render loop up, there is new data for `commands`. Safe to call
+    from any thread.
+    """
+    try:
+        pygame.event.post(pygame.event.Event(SNAPSHOT_EVENT, commands=commands))
+    except pygame.error:
+        # The render loop is gone, the window was closed
+        pass
+
+
+class FrameScheduler:
+    """
+    Keeps the render loop asleep until a frame is due: right away after a key
+    or new data of the screen shown, else once the screen asks to be refreshed.
+    While the window is hidden or not focused new data does not wake it up and
+    frames are at least `idle_interval` apart.
+    """
+
+    WAKE_EVENTS = {
+        pygame.KEYDOWN,
+        pygame.WINDOWSHOWN,
+        pygame.WINDOWRESTORED,
+        pygame.WINDOWFOCUSGAINED,
+        pygame.WINDOWEXPOSED,
+    }
+
+    def __init__(self, idle_interval=IDLE_INTERVAL):
+        self.idle_interval = idle_interval
+
+        self.visible = True
+        self.focused = True
+
+        self.drawn_at = None
+        self.due_at = 0
+
+    @property
+    def idle(self):
+        return not (self.visible and self.focused)
+
+    def wait(self, speed):
+        """
+        The events arrived, when there are none sleeps until one arrives or the
+        next frame is due. Where SDL can not wait for events without polling,
+        sleeps instead, looking for them again at most `1 / speed` seconds
+        later.
+        """
+        events = pygame.event.get()
+        timeout = self.due_at - time.monotonic()
+        if events or timeout <= 0:
+            return events
+
+        if not WAITS_FOR_EVENTS:
+            pygame.time.wait(math.ceil(min(timeout, 1 / speed) * 1000))
+            return []
+
+        event = pygame.event.wait(math.ceil(timeout * 1000))
+        if event.type == pygame.NOEVENT:
+            return []
+        return [event] + pygame.event.get()
+
+    def handle(self, event, watcher):
+        if event.type in (pygame.WINDOWHIDDEN, pygame.WINDOWMINIMIZED):
+            self.visible = False
+        elif event.type in (pygame.WINDOWSHOWN, pygame.WINDOWRESTORED):
+            self.visible = True
+        elif event.type == pygame.WINDOWFOCUSLOST:
+            self.focused = False
+        elif event.type == pygame.WINDOWFOCUSGAINED:
+            self.focused = True
+
+        if event.type in self.WAKE_EVENTS:
+            self.wake(watcher.speed)
+        elif event.type == SNAPSHOT_EVENT and not self.idle:
+            if watcher.shows(event.commands):
+                self.wake(watcher.speed)
+
+    def wake(self, speed):
+        """
+        Makes the next frame due now, `speed` frames per second at most.
+        """
+        now = time.monotonic()
+        if self.drawn_at is not None:
+            now = max(now, self.drawn_at + 1 / speed)
+        self.due_at = min(self.due_at, now)
+
+    @property
+    def due(self):
+        return time.monotonic() >= self.due_at
+
+    def drawn(self, interval):
+        self.drawn_at = time.monotonic()
+        if self.idle:
+            interval = max(interval, self.idle_interval)
+        self.due_at = self.drawn_at + interval
+
+
 class BaseComponent(ABC):
     @abstractmethod
     def draw(self, *args, **kwargs):
@@ -53,21 +289,31 @@ class BaseComponent(ABC):
 
 
 class Text(BaseComponent):
-    def __init__(self):
-        self.font = pygame.font.Font(FONT_STYLE, FONT_SIZE)
+    def __init__(self, color=WHITE, size=FONT_SIZE):
+        self.color = color
+        self.size = size
 
     def draw(self, title, position, *args, **kwargs):
-        text = self.font.render(title, True, WHITE)
-        screen.blit(text, position)
-        return text.get_rect()
+        text = texts.render(title, self.color, self.size)
+        rect = text.get_rect(topleft=position)
+        renderer.add(
+            rect,
+            ("text", title, self.color, self.size),
+            partial(screen.blit, text, rect),
+        )
+        return rect
 
 
 class Rect(BaseComponent):
     def __init__(self, x, y, width, height):
-        self.rect = pygame.Rect(x, y, width, height)
+        self.rect = (x, y, width, height)
 
     def draw(self, color):
-        pygame.draw.rect(screen, color, self.rect)
+        renderer.add(
+            self.rect,
+            ("rect", color),
+            partial(pygame.draw.rect, screen, color, self.rect),
+        )
 
 
 class UsageBar(BaseComponent):
@@ -89,10 +335,68 @@ class VerticalUsageBar(BaseComponent):
         Rect(x, y + height - height * percentage, width, height * percentage).draw(RED)
 
 
+class Table(BaseComponent):
+    SPACING = 20
+
+    def draw(self, rows, position, column_width):
+        x, y = position
+
+        for row_idx, row in enumerate(rows):
+            for column_idx, cell in enumerate(row):
+                cell_position = (
+                    x + column_idx * column_width,
+                    y + row_idx * self.SPACING,
+                )
+                Text().draw(str(cell), cell_position)
+
+
+@lru_cache(maxsize=8)
+def _graph_frame(width, height):
+    frame = pygame.Surface((width, height), pygame.SRCALPHA)
+    pygame.draw.rect(frame, WHITE, frame.get_rect(), 1)
+    return frame
+
+
+class HistoryGraph(BaseComponent):
+    def draw(self, values, size, position, width, height, top=1):
+        values = tuple(values)
+        # The line may end one pixel past the frame
+        rect = (*position, width + 1, height + 1)
+        renderer.add(
+            rect,
+            ("history", values, size, top),
+            partial(self._draw, values, size, position, width, height, top),
+        )
+
+    @staticmethod
+    def _draw(values, size, position, width, height, top):
+        x, y = position
+
+        screen.blit(_graph_frame(width, height), position)
+        if len(values) < 2:
+            return
+
+        # The newest sample is always on the right edge, `size` samples fill it
+        step = width / (size - 1)
+        x_start = x + width - step * (len(values) - 1)
+        points = [
+            (x_start + idx * step, y + height - height * min(value / top, 1))
+            for idx, value in enumerate(values)
+        ]
+        pygame.draw.lines(screen, GREEN, False, points)
+
+
 class BaseScreen(BaseComponent, ABC):
-    def __init__(self):
-        self.font = pygame.font.Font(FONT_STYLE, FONT_SIZE)
+    history = None
+    history_command = None
+    # Set when the details drawn are the last good ones and not current
+    stale = False
+    # Commands whose new data is drawn right away, and seconds between two
+    # frames without any
+    sources = ()
+    refresh_interval = 1
 
+    def __init__(self):
         self.spacing = 20
         self.start_position = 35
 
@@ -107,10 +411,11 @@ class BaseScreen(BaseComponent, ABC):
         return MARGIN_X, MARGIN_Y
 
     def _draw_text(self):
-        # TODO: use Text class
-        text = self.font.render(self.title, True, WHITE)
         x, y = self._get_text_center()
-        screen.blit(text, (x, y))
+        text = Text().draw(self.title, (x, y))
+
+        if self.stale:
+            Text(RED).draw("(stale)", (x + text.width + 10, y))
 
     def _draw_frame(self):
         pass
@@ -140,18 +445,64 @@ class BaseScreen(BaseComponent, ABC):
 
         UsageBar().draw(usage, y_start, width, height)
 
+    def draw_history(self, column="usage"):
+        if self.history is None:
+            return
+
+        history = self.history.get(self.history_command)
+        if not history:
+            return
+
+        y_start = HEIGHT - MARGIN_Y - 20 - HISTORY_HEIGHT - self.spacing
+        line = (
+            f"History - min: {history.min(column):.0%} "
+            f"avg: {history.avg(column):.0%} "
+            f"p95: {history.percentile(column, 95):.0%} "
+            f"max: {history.max(column):.0%}"
+        )
+        Text().draw(line, (MARGIN_X, y_start))
+
+        HistoryGraph().draw(
+            history.window(column),
+            history.size,
+            (MARGIN_X, y_start + self.spacing),
+            WIDTH - 2 * MARGIN_X,
+            HISTORY_HEIGHT,
+        )
+
+    def draw_table(self, rows, lines):
+        """
+        Draws the table on the window, below the `lines` of details.
+        """
+        y_start = MARGIN_Y + self.start_position + (lines + 1) * self.spacing
+
+        column_width = (WIDTH - 2 * MARGIN_X) / len(rows[0])
+        Table().draw(rows, (MARGIN_X, y_start), column_width)
+
     def draw(self, *args, **kwargs):
         self._draw_text()
 
         self.draw_details()
         self.draw_usage()
+        self.draw_history()
+
+    def draw_waiting(self):
+        """
+        Stands in for the screen until there are details to draw.
+        """
+        self._draw_text()
+        Text().draw("Collecting...", (MARGIN_X, MARGIN_Y + self.start_position))
 
 
 class CPUDetails(BaseScreen):
     title = "CPU"
+    history_command = Screens.CPU
+    sources = (Screens.CPU,)
+    refresh_interval = INTERVALS[Screens.CPU]
 
-    def __init__(self, cpu_service=None):
+    def __init__(self, cpu_service=None, history=None):
         self.cpu_service = cpu_service or CPUService()
+        self.history = history
         super().__init__()
 
     def draw_usage(self, usage=None, position=None, height=None):
@@ -162,6 +513,9 @@ class CPUDetails(BaseScreen):
 
         width = ((WIDTH - 2 * MARGIN_X) / len(usages)) - right_margin
         height = HEIGHT - 20 - y - MARGIN_Y
+        if self.history is not None:
+            # Leaves room for the history graph below the bars
+            height -= HISTORY_HEIGHT + 2 * self.spacing
 
         for idx, usage in enumerate(usages):
             x = MARGIN_X + right_margin / 2 + idx * (right_margin + width)
@@ -187,9 +541,13 @@ class CPUDetails(BaseScreen):
 
 class MemoryDetails(BaseScreen):
     title = "Memory"
+    history_command = Screens.MEMORY
+    sources = (Screens.MEMORY,)
+    refresh_interval = INTERVALS[Screens.MEMORY]
 
-    def __init__(self, memory_service=None):
+    def __init__(self, memory_service=None, history=None):
         self.memory_service = memory_service or MemoryService()
+        self.history = history
         super().__init__()
 
     def draw_usage(self, usage=None, position=None, height=None):
@@ -212,9 +570,13 @@ class MemoryDetails(BaseScreen):
 
 class DiskDetails(BaseScreen):
     title = "Disk"
+    history_command = Screens.DISK
+    sources = (Screens.DISK,)
+    refresh_interval = INTERVALS[Screens.DISK]
 
-    def __init__(self, disk_service=None):
+    def __init__(self, disk_service=None, history=None):
         self.disk_service = disk_service or DiskService()
+        self.history = history
         super().__init__()
 
     def draw_usage(self, usage=None, position=None, height=None):
@@ -237,6 +599,8 @@ class DiskDetails(BaseScreen):
 
 class DataUsageDetails(BaseScreen):
     title = "Data Usage"
+    sources = (Screens.DATA_USAGE,)
+    refresh_interval = INTERVALS[Screens.DATA_USAGE]
 
     def __init__(self, data_usage_service=None, table_service=None):
         self.dt_service = data_usage_service or DataUsageService()
@@ -259,6 +623,7 @@ class DataUsageDetails(BaseScreen):
             ("Errout", self.dt_service.errout, None),
         ]
         super().draw_details(details)
+        self.draw_table(self.dt_service.interfaces, len(details))
 
         pids_connections = self.dt_service.pids_connections
         self.table_service.draw(pids_connections)
@@ -266,6 +631,8 @@ class DataUsageDetails(BaseScreen):
 
 class NetworkDetails(BaseScreen):
     title = "Network"
+    sources = (Screens.NETWORK, Screens.SCANNER)
+    refresh_interval = INTERVALS[Screens.SCANNER]
 
     def __init__(self, network_service=None, scanner_service=None, table_service=None):
         self.network_service = network_service or NetworkService()
@@ -276,22 +643,35 @@ class NetworkDetails(BaseScreen):
     def draw_usage(self, usage=None, position=None, height=None):
         pass
 
-    def get_map_network(self, internal_ip):
-        return self.scanner_service.map_network(internal_ip)
+    def get_scan(self, internal_ip, sub_mask):
+        return (
+            self.scanner_service.map_network(internal_ip, sub_mask),
+            self.scanner_service.progress(internal_ip, sub_mask),
+            self.scanner_service.hosts_found(internal_ip, sub_mask),
+            self.scanner_service.added(internal_ip, sub_mask),
+            self.scanner_service.removed(internal_ip, sub_mask),
+        )
 
     def draw_details(self, details=None, *args, **kwargs):
         internal_ip = self.network_service.ip
+        sub_mask = self.network_service.sub_mask
+        subnet_hosts, progress, hosts_found, added, removed = self.get_scan(
+            internal_ip, sub_mask
+        )
+        scan = f"{progress:.0%}, {hosts_found} hosts (+{len(added)} -{len(removed)})"
+
         details = [
             ("Interface", self.network_service.interface_name, None),
             ("IP", internal_ip, None),
             ("Gateway", self.network_service.gateway, None),
-            ("SubMask", self.network_service.sub_mask, None),
+            ("SubMask", sub_mask, None),
+            ("Scan", scan, None),
             *EMPTY_LINES,
             ("More details on the terminal", "", None),
         ]
         super().draw_details(details)
+        self.draw_table(self.network_service.interfaces, len(details))
 
-        subnet_hosts = self.get_map_network(internal_ip)
         self.table_service.draw(subnet_hosts)
 
     def draw(self, *args, **kwargs):
@@ -301,6 +681,8 @@ class NetworkDetails(BaseScreen):
 
 class ProcessDetails(BaseScreen):
     title = "Process"
+    sources = (Screens.PROCESS,)
+    refresh_interval = INTERVALS[Screens.PROCESS]
 
     def __init__(self, process_service=None, table_service=None):
         self.process_service = process_service or ProcessService()
@@ -318,6 +700,8 @@ class ProcessDetails(BaseScreen):
 
 class SystemDetails(BaseScreen):
     title = "System"
+    sources = (Screens.SYSTEM,)
+    refresh_interval = INTERVALS[Screens.SYSTEM]
 
     def __init__(self, system_service=None, table_service=None):
         self.system_service = system_service or SystemService()
@@ -335,6 +719,8 @@ class SystemDetails(BaseScreen):
 
 class Summary(BaseScreen):
     title = "Summary"
+    sources = (Screens.CPU, Screens.DISK, Screens.MEMORY)
+    refresh_interval = INTERVALS[Screens.CPU]
 
     def __init__(self, disk_details=None, cpu_details=None, memory_details=None):
         self.disk_details = disk_details or DiskDetails()
@@ -355,32 +741,80 @@ class Summary(BaseScreen):
 
 
 class Watcher(BaseComponent):
-    def __init__(self, screens=None, summary=None):
+    def __init__(self, screens=None, summary=None, engine=None):
         # Settings
         self.speed = FPS
 
+        # Local screens read from collectors running in the background, so a
+        # slow service never holds a frame back.
+        self.engine = None
+        if screens is None or summary is None:
+            self.engine = engine or SamplingEngine.default()
+            for command, collector in self.engine.collectors.items():
+                collector.publisher.register(partial(self._notify, command))
+            self.engine.start()
+
         self.screens = screens or (
-            CPUDetails(),
-            MemoryDetails(),
-            DiskDetails(),
-            NetworkDetails(),
-            ProcessDetails(),
-            DataUsageDetails(),
-            SystemDetails(),
+            CPUDetails(
+                cpu_service=self.engine.view(Screens.CPU),
+                history=self.engine.history,
+            ),
+            MemoryDetails(
+                memory_service=self.engine.view(Screens.MEMORY),
+                history=self.engine.history,
+            ),
+            DiskDetails(
+                disk_service=self.engine.view(Screens.DISK),
+                history=self.engine.history,
+            ),
+            NetworkDetails(
+                network_service=self.engine.view(Screens.NETWORK),
+                scanner_service=self.engine.view(Screens.SCANNER),
+            ),
+            ProcessDetails(process_service=self.engine.view(Screens.PROCESS)),
+            DataUsageDetails(data_usage_service=self.engine.view(Screens.DATA_USAGE)),
+            SystemDetails(system_service=self.engine.view(Screens.SYSTEM)),
+        )
+        self.summary = summary or (
+            Summary(
+                disk_details=DiskDetails(self.engine.view(Screens.DISK)),
+                cpu_details=CPUDetails(self.engine.view(Screens.CPU)),
+                memory_details=MemoryDetails(self.engine.view(Screens.MEMORY)),
+            ),
         )
-        self.summary = summary or (Summary(),)
         self.is_summary_open = False
 
         self.screen_idx = None
 
+    @staticmethod
+    def _notify(command, snapshot):
+        post_snapshot(command)
+
+    @property
+    def current(self):
+        if self.is_summary_open:
+            return self.summary[0]
+        return self.screens[self.screen_idx or 0]
+
+    @property
+    def refresh_interval(self):
+        return self.current.refresh_interval
+
+    def shows(self, commands):
+        """
+        Whether the screen shown draws any of `commands`.
+        """
+        return any(command in self.current.sources for command in commands)
+
     def draw(self, *args, **kwargs):
         if not self.screen_idx:
             self.screen_idx = 0
 
-        if self.is_summary_open:
-            self.summary[0].draw()
-        else:
-            self.screens[self.screen_idx].draw()
+        try:
+            self.current.draw()
+        except NoSnapshot:
+            renderer.discard()
+            self.current.draw_waiting()
 
     def _handle_summary(self):
         if self.is_summary_open:
@@ -413,7 +847,7 @@ def main(watcher=None):
     is_running = True
 
     pygame.init()
-    clock = pygame.time.Clock()
+    scheduler = FrameScheduler()
     watcher = watcher() if callable(watcher) else Watcher()
 
     pub = Publisher()
@@ -422,19 +856,28 @@ def main(watcher=None):
     clean_terminal()
 
     while is_running:
-        events = pygame.event.get()
-
-        for event in events:
+        for event in scheduler.wait(watcher.speed):
             if event.type == pygame.KEYDOWN:
                 pub.dispatch(event)
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                renderer.invalidate()
+
+            scheduler.handle(event, watcher)
 
             if handle_quit(event):
                 is_running = False
 
-        screen.fill(BLACK)
+        if not is_running or not scheduler.due:
+            continue
+
         watcher.draw()
-        pygame.display.update()
-        clock.tick(watcher.speed)
+        dirty = renderer.render()
+        if dirty:
+            pygame.display.update(dirty)
+        scheduler.drawn(watcher.refresh_interval)
+
+    if watcher.engine:
+        watcher.engine.stop()
 
     pygame.display.quit()
     pygame.quit()
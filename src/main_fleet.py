@@ -0,0 +1,79 @@
+import pygame
+
+import main
+from fleet import (
+    FLEET,
+    FLEET_INTERVAL,
+    RELAYS,
+    SORT_KEYS,
+    BackgroundFleet,
+    parse_servers,
+)
+
+# Rows of hosts fitting in the window below the details
+FLEET_ROWS = 19
+
+
+def _usages(summary):
+    if summary is None:
+        return "-"
+    return " / ".join(f"{usage:.0%}" for usage in summary)
+
+
+class FleetOverview(main.BaseScreen):
+    title = "Fleet"
+    refresh_interval = FLEET_INTERVAL
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.sort = SORT_KEYS[0]
+        super().__init__()
+
+    def next_sort(self):
+        self.sort = SORT_KEYS[(SORT_KEYS.index(self.sort) + 1) % len(SORT_KEYS)]
+        # Relays send the first rows by it from the next refresh on
+        self.fleet.sort = self.sort
+
+    def draw_details(self, details=None, *args, **kwargs):
+        rollup = self.fleet.rollup(top=0)
+        details = (
+            ("Hosts", len(self.fleet), None),
+            ("Answering", self.fleet.answering, None),
+            ("CPU avg / p95 / max", _usages(rollup.cpu), None),
+            ("Memory avg / p95 / max", _usages(rollup.memory), None),
+            (
+                "Memory available",
+                f"{rollup.memory_available:.0f} of {rollup.memory_total:.0f}",
+                "GB",
+            ),
+            ("Sorted by", f"{self.sort} (S to change)", None),
+        )
+        super().draw_details(details)
+
+        self.draw_table(self.fleet.rows(self.sort, FLEET_ROWS), len(details))
+
+    def draw_usage(self, usage=None, y_start=None, title=None):
+        pass
+
+
+class FleetWatcher(main.Watcher):
+    def __init__(self, fleet=None):
+        if fleet is None:
+            fleet = BackgroundFleet(
+                parse_servers(FLEET), parse_servers(RELAYS), relay_rows=FLEET_ROWS
+            )
+        self.fleet = fleet
+        self.fleet.start()
+
+        self.overview = FleetOverview(self.fleet)
+        super().__init__((self.overview,), (self.overview,))
+
+    def handle_event(self, event):
+        if event.key == pygame.K_s:
+            self.overview.next_sort()
+        else:
+            super().handle_event(event)
+
+
+if __name__ == "__main__":
+    main.main(lambda: FleetWatcher())
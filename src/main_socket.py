@@ -1,9 +1,35 @@
 from abc import ABC, abstractmethod
 
 import main
-from client import get_details
+from client import client, prefetch, watch, watch_many
+from collectors import INTERVALS, NoSnapshot
 from constants import Screens
 
+# Seconds a subscription outlives the last frame that watched it: frames are
+# never further apart than the slowest screen asks or than while idle
+WATCH_TTL = 2 * max(*INTERVALS.values(), main.IDLE_INTERVAL)
+
+
+class PushedView:
+    """
+    Stands in for a service on the socket screens: every attribute is read from
+    the last details pushed by the server, so nothing is collected locally
+    while none arrived.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.details = None
+
+    def update(self, details):
+        if details is not None:
+            self.details = details
+
+    def __getattr__(self, item):
+        if self.details is None:
+            raise NoSnapshot(self.command)
+        return getattr(self.details, item)
+
 
 class BaseSocketScreen(main.BaseScreen, ABC):
     @property
@@ -11,10 +37,31 @@ class BaseSocketScreen(main.BaseScreen, ABC):
     def screen_command(self):
         return
 
+    @property
+    def interval(self):
+        """
+        Seconds between two pushes of the details by the server.
+        """
+        return INTERVALS[self.screen_command]
+
+    @property
+    def refresh_interval(self):
+        return self.interval
+
+    @property
+    def commands(self):
+        return ((self.screen_command, ()),)
+
     @abstractmethod
     def get_details(self):
         pass
 
+    def prefetch(self):
+        """
+        Starts receiving the details before the screen is shown.
+        """
+        prefetch(*self.commands, interval=self.interval)
+
     def draw(self, *args, **kwargs):
         self.get_details()
         super().draw(*args, **kwargs)
@@ -24,30 +71,33 @@ class SocketCPUDetails(BaseSocketScreen, main.CPUDetails):
     screen_command = Screens.CPU
 
     def __init__(self):
-        super().__init__(cpu_service=get_details(self.screen_command))
+        super().__init__(cpu_service=PushedView(self.screen_command))
 
     def get_details(self):
-        self.cpu_service = get_details(self.screen_command)
+        details, self.stale = watch(self.screen_command, interval=self.interval)
+        self.cpu_service.update(details)
 
 
 class SocketMemoryDetails(BaseSocketScreen, main.MemoryDetails):
     screen_command = Screens.MEMORY
 
     def __init__(self):
-        super().__init__(memory_service=get_details(self.screen_command))
+        super().__init__(memory_service=PushedView(self.screen_command))
 
     def get_details(self):
-        self.memory_service = get_details(self.screen_command)
+        details, self.stale = watch(self.screen_command, interval=self.interval)
+        self.memory_service.update(details)
 
 
 class SocketDiskDetails(BaseSocketScreen, main.DiskDetails):
     screen_command = Screens.DISK
 
     def __init__(self):
-        super().__init__(disk_service=get_details(self.screen_command))
+        super().__init__(disk_service=PushedView(self.screen_command))
 
     def get_details(self):
-        self.disk_service = get_details(self.screen_command)
+        details, self.stale = watch(self.screen_command, interval=self.interval)
+        self.disk_service.update(details)
 
 
 class SocketNetworkDetails(BaseSocketScreen, main.NetworkDetails):
@@ -55,62 +105,102 @@ class SocketNetworkDetails(BaseSocketScreen, main.NetworkDetails):
 
     def __init__(self):
         super().__init__(
-            network_service=get_details(self.screen_command),
-            scanner_service=get_details(Screens.SCANNER, None),
+            network_service=PushedView(self.screen_command),
+            scanner_service=PushedView(Screens.SCANNER),
+        )
+
+    def get_scan(self, internal_ip, sub_mask):
+        scan = self.scanner_service
+        return (
+            scan.map_network,
+            scan.progress,
+            scan.hosts_found,
+            scan.added,
+            scan.removed,
         )
 
-    def get_map_network(self, internal_ip):
-        return get_details(Screens.SCANNER, internal_ip).map_network
+    @property
+    def interval(self):
+        return INTERVALS[Screens.SCANNER]
+
+    @property
+    def commands(self):
+        # The scan is asked for the address of the last answer, which only
+        # changes when the machine moves to another network
+        network = self.network_service.details
+        scan_args = (
+            (network.ip, network.sub_mask) if network is not None else (None, None)
+        )
+        return (self.screen_command, ()), (Screens.SCANNER, scan_args)
 
     def get_details(self):
-        self.network_service = get_details(self.screen_command)
+        answers, self.stale = watch_many(*self.commands, interval=self.interval)
+        if answers:
+            network, scan = answers
+            self.network_service.update(network)
+            self.scanner_service.update(scan)
 
 
 class SocketProcessDetails(BaseSocketScreen, main.ProcessDetails):
     screen_command = Screens.PROCESS
 
     def __init__(self):
-        super().__init__(process_service=get_details(self.screen_command))
+        super().__init__(process_service=PushedView(self.screen_command))
 
     def get_details(self):
-        self.process_service = get_details(self.screen_command)
+        details, self.stale = watch(self.screen_command, interval=self.interval)
+        self.process_service.update(details)
 
 
 class SocketDataUsageDetails(BaseSocketScreen, main.DataUsageDetails):
     screen_command = Screens.DATA_USAGE
 
     def __init__(self):
-        super().__init__(data_usage_service=get_details(self.screen_command))
+        super().__init__(data_usage_service=PushedView(self.screen_command))
 
     def get_details(self):
-        self.dt_service = get_details(self.screen_command)
+        details, self.stale = watch(self.screen_command, interval=self.interval)
+        self.dt_service.update(details)
 
 
 class SocketSystemDetails(BaseSocketScreen, main.SystemDetails):
     screen_command = Screens.SYSTEM
 
     def __init__(self):
-        super().__init__(system_service=get_details(self.screen_command))
+        super().__init__(system_service=PushedView(self.screen_command))
 
     def get_details(self):
-        self.system_service = get_details(self.screen_command)
+        details, self.stale = watch(self.screen_command, interval=self.interval)
+        self.system_service.update(details)
 
 
 class SocketSummary(main.Summary):
     screen_command = Screens.SUMMARY
+    commands = ((Screens.DISK, ()), (Screens.CPU, ()), (Screens.MEMORY, ()))
 
     def __init__(self):
         super().__init__(
-            disk_details=SocketDiskDetails(),
-            cpu_details=SocketCPUDetails(),
-            memory_details=SocketMemoryDetails(),
+            disk_details=main.DiskDetails(disk_service=PushedView(Screens.DISK)),
+            cpu_details=main.CPUDetails(cpu_service=PushedView(Screens.CPU)),
+            memory_details=main.MemoryDetails(
+                memory_service=PushedView(Screens.MEMORY)
+            ),
         )
 
-    def draw(self, *args, **kwargs):
-        self.disk_details = SocketDiskDetails()
-        self.cpu_details = SocketCPUDetails()
-        self.memory_details = SocketMemoryDetails()
+    def get_details(self):
+        answers, self.stale = watch_many(
+            *self.commands, interval=INTERVALS[Screens.CPU]
+        )
+        if not answers:
+            return
 
+        disk, cpu, memory = answers
+        self.disk_details.disk_service.update(disk)
+        self.cpu_details.cpu_service.update(cpu)
+        self.memory_details.memory_service.update(memory)
+
+    def draw(self, *args, **kwargs):
+        self.get_details()
         super().draw()
 
 
@@ -130,6 +220,30 @@ class SocketWatcher(main.Watcher):
 
         super().__init__(screens, summary)
 
+        client.watch_ttl = WATCH_TTL
+        client.client.publisher.register(self._notify_push)
+
+    @staticmethod
+    def _notify_push(commands):
+        main.post_snapshot(*commands)
+
+    def prefetch(self):
+        """
+        Keeps the screens next to the current one receiving their details, so
+        moving to them draws current details right away. Once they are not
+        next to it anymore their subscriptions expire.
+        """
+        if self.is_summary_open:
+            return
+
+        for direction in (-1, 1):
+            idx = (self.screen_idx + direction) % len(self.screens)
+            self.screens[idx].prefetch()
+
+    def draw(self, *args, **kwargs):
+        super().draw(*args, **kwargs)
+        self.prefetch()
+
 
 if __name__ == "__main__":
     main.main(lambda: SocketWatcher())
@@ -2,7 +2,7 @@ from dataclasses import dataclass
 from typing import List
 
 
-@dataclass
+@dataclass(frozen=True)
 class CPUModel:
     usage_per_cpu: List[str]
     brand: str
@@ -14,7 +14,7 @@ class CPUModel:
     current_frequency: str
 
 
-@dataclass
+@dataclass(frozen=True)
 class MemoryModel:
     usage: str
     total: str
@@ -22,7 +22,7 @@ class MemoryModel:
     pretty_usage: str
 
 
-@dataclass
+@dataclass(frozen=True)
 class DiskModel:
     usage: str
     total: str
@@ -30,25 +30,30 @@ class DiskModel:
     pretty_usage: str
 
 
-@dataclass
+@dataclass(frozen=True)
 class NetworkModel:
     ip: str
     interface_name: str
     gateway: str
     sub_mask: str
+    interfaces: List
 
 
-@dataclass
+@dataclass(frozen=True)
 class ScannerModel:
     map_network: List
+    progress: float
+    hosts_found: int
+    added: List
+    removed: List
 
 
-@dataclass
+@dataclass(frozen=True)
 class ProcessModel:
     pids: List
 
 
-@dataclass
+@dataclass(frozen=True)
 class DataUsageModel:
     interface_name: str
     bytes_sent: str
@@ -60,8 +65,25 @@ class DataUsageModel:
     errin: str
     errout: str
     pids_connections: List
+    interfaces: List
 
 
-@dataclass
+@dataclass(frozen=True)
 class SystemModel:
     dirs: List
+
+
+@dataclass(frozen=True)
+class FleetModel:
+    hosts: int
+    answering: int
+    cpu: List[float]
+    memory: List[float]
+    disk: List[float]
+    memory_total: float
+    memory_available: float
+    disk_total: float
+    disk_available: float
+    top_cpu: List
+    top_memory: List
+    rows: List
@@ -0,0 +1,87 @@
+"""
+Serves the rollups of a fleet, so dashboards ask a single relay whatever the
+number of servers behind it. The relay refreshes the fleet on its own schedule
+and answers the FLEET command from the latest snapshots, every other command
+is answered for its own host like any server.
+"""
+import asyncio
+import os
+
+from constants import Screens
+from fleet import (
+    FLEET,
+    FLEET_INTERVAL,
+    RELAYS,
+    SORT_KEYS,
+    TOP_HOSTS,
+    Fleet,
+    parse_servers,
+)
+from server import RequestHandler, serve
+from transport import HOST, PORT, TRANSPORT, UNIX, check_transport
+
+# Rows a dashboard may ask for at once
+MAX_ROWS = 100
+# Next to the server of its own host by default
+RELAY_PORT = int(os.environ.get("WATCHER_RELAY_PORT", PORT + 1))
+RELAY_SOCKET_PATH = os.environ.get("WATCHER_RELAY_SOCKET", "/tmp/watcher-relay.sock")
+
+
+class RelayHandler(RequestHandler):
+    """
+    A request handler answering FLEET with the rollup of `fleet`. Its
+    arguments may ask for the rows of every host, as ("rows",), which relays
+    higher up use, or for the first ones by a sort key, as ("rows", key,
+    limit), which dashboards use.
+    """
+
+    def __init__(self, fleet, top=TOP_HOSTS, **kwargs):
+        super().__init__(**kwargs)
+        self.fleet = fleet
+        self.top = top
+
+    async def _collect(self, command, args):
+        if command != Screens.FLEET:
+            return await super()._collect(command, args)
+
+        args = tuple(args or ())
+        if not args:
+            return self.fleet.rollup(self.top)
+        if args == ("rows",):
+            return self.fleet.rollup(self.top, rows=True)
+
+        _, key, limit = args if len(args) == 3 else (None, None, None)
+        if key not in SORT_KEYS or type(limit) is not int or not 0 < limit <= MAX_ROWS:
+            print(f"Invalid fleet arguments {args!r}")
+            return None
+        return self.fleet.rollup(self.top, rows=True, key=key, limit=limit)
+
+
+async def relay(
+    servers,
+    relays=(),
+    interval=FLEET_INTERVAL,
+    host=HOST,
+    port=RELAY_PORT,
+    transport=TRANSPORT,
+    path=RELAY_SOCKET_PATH,
+):
+    fleet = Fleet(servers, relays, transport)
+    refresh = asyncio.ensure_future(fleet.run(interval))
+
+    try:
+        await serve(host, port, transport, path, RelayHandler(fleet))
+    finally:
+        refresh.cancel()
+
+
+if __name__ == "__main__":
+    check_transport(TRANSPORT)
+    servers = parse_servers(FLEET)
+    relays = parse_servers(RELAYS)
+    where = RELAY_SOCKET_PATH if TRANSPORT == UNIX else RELAY_PORT
+    print(
+        f"Relaying {len(servers)} servers and {len(relays)} relays "
+        f"over {TRANSPORT} on {where}..."
+    )
+    asyncio.run(relay(servers, relays))
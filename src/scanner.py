@@ -1,87 +1,230 @@
-import os
-import subprocess
+import asyncio
+import ipaddress
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import nmap
+import psutil
 
-from helpers import threader
+from discovery import Discovery, PortScanner, socket_budget
+from inventory import Inventory
+from workers import pool
+
+try:
+    import nmap
+except ImportError:  # Only the deep scan backend needs it
+    nmap = None
 
 POOL_SIZE = 255
-INTERVAL_UPDATE = 100 * 20
 PORTS = "22,80,443"
 
-DEVNULL = open(os.devnull, "w")
+# Bigger networks are narrowed to the /16 around the host, smaller ones widened
+MIN_PREFIX = 16
+MAX_PREFIX = 30
+DEFAULT_PREFIX = 24
+# Hosts swept at once, a /16 is scanned in 256 chunks
+CHUNK_SIZE = 256
+# Known hosts due for a recheck are looked at every RESCAN_INTERVAL, the whole
+# network is only swept for new hosts every SWEEP_INTERVAL
+RESCAN_INTERVAL = 30
+SWEEP_INTERVAL = 5 * 60
 
+NATIVE_BACKEND = "native"
+NMAP_BACKEND = "nmap"
 
-class Scanner:
-    def __init__(self):
-        self.nm = nmap.PortScanner()
-        self.counter = 0
+# Cycles wait on the jobs they give the worker pool, so they run on their own
+# threads: with the pool busy they would hold workers their jobs need
+CYCLE_WORKERS = 4
+cycles = ThreadPoolExecutor(CYCLE_WORKERS, thread_name_prefix="scan")
 
-        self.scanned = []
 
-    @staticmethod
-    def get_base_ip(raw_host):
-        return ".".join(raw_host.split(".")[0:3])
+class Scanner:
+    """
+    Scans the subnet of the host in the background into an Inventory,
+    `map_network` only returns what is known so far and starts a new cycle when
+    one is due. A cycle rechecks the known hosts whose time has come and, now
+    and then, sweeps the rest of the network for new ones.
+    """
+
+    def __init__(self, backend=NATIVE_BACKEND, ports=PORTS):
+        self.backend = backend
+        self.ports = ports
+
+        self.nm = None
+        if backend == NMAP_BACKEND:
+            if nmap is None:
+                raise ImportError("The nmap backend needs python-nmap installed")
+            self.nm = nmap.PortScanner()
+
+        self.network = None
+        self.inventory = Inventory()
+        self.total = 0
+        self.swept = 0
+        self.scanned_at = None
+        self.swept_at = None
+
+        self._discovery = None
+        self._cycle = None
+        self._lock = threading.Lock()
 
     @staticmethod
-    def _build_ping():
+    def is_local(raw_host, sub_mask=None):
         """
-        @https://phoenixnap.com/kb/linux-ping-command-examples
-            c: Limits the number of sent ping requests.
-            w: Specifies a time limit before the ping command exits, regardless
-             of how many packets have been sent or received.
-            W: Determines the time, in seconds, to wait for a response.
-            l: Defines the number of packets to send without waiting for a reply
-            n: Displays IP addresses in the ping output rather than hostnames.
+        Whether `raw_host` and `sub_mask` are the address and mask of one of the
+        interfaces of this machine, only their networks are scanned.
         """
-        if "nt" in os.name:
-            return ["ping", "-n", "1", "-l", "1", "-w", "100"]
-        else:
-            return ["ping", "-c", "1", "-W", "1"]
-
-    def _pinger(self, job_queue, results_queue):
-        pinger_command = self._build_ping()
-        while True:
-            ip = job_queue.get()
-            if ip is None:
-                break
-            try:
-                subprocess.check_call([*pinger_command, ip], stdout=DEVNULL)
-                results_queue.put(ip)
-            except Exception:  # noqa: E722
-                pass
-
-    def _map_network(self, raw_host, pool_size):
-        base_ip = self.get_base_ip(raw_host)
-        ips = [f"{base_ip}.{i}" for i in range(255)]
-
-        return threader(self._pinger, ips, pool_size)
+        interface = ipaddress.ip_interface(f"{raw_host}/{sub_mask or DEFAULT_PREFIX}")
+        return any(
+            address.family == socket.AF_INET
+            and address.netmask
+            and ipaddress.ip_interface(f"{address.address}/{address.netmask}")
+            == interface
+            for addresses in psutil.net_if_addrs().values()
+            for address in addresses
+        )
+
+    @staticmethod
+    def get_network(raw_host, sub_mask=None):
+        interface = ipaddress.ip_interface(f"{raw_host}/{sub_mask or DEFAULT_PREFIX}")
+        prefix = min(max(interface.network.prefixlen, MIN_PREFIX), MAX_PREFIX)
+
+        return ipaddress.ip_interface(f"{raw_host}/{prefix}").network
+
+    @staticmethod
+    def _chunks(hosts):
+        for start in range(0, len(hosts), CHUNK_SIZE):
+            yield hosts[start : start + CHUNK_SIZE]
+
+    def _add(self, host, port, state):
+        with self._lock:
+            self.inventory.seen(host, port, state, time.monotonic())
 
     def _map_network_ports(self, host):
+        """
+        Deep scan of a single host through nmap. The parsed result is read from
+        the return value, the scanner's own copy is shared by every worker.
+        """
         result = []
 
-        self.nm.scan(host, ports=PORTS)
-        try:
-            for protocol in self.nm[host].all_protocols():
-                for port in self.nm[host][protocol].keys():
-                    state = self.nm[host][protocol][port]["state"]
-                    result.append((port, state))
-        except KeyError:
-            pass
+        scan = self.nm.scan(host, ports=self.ports)
+        for protocol, ports in scan["scan"].get(host, {}).items():
+            if protocol not in ("tcp", "udp", "sctp", "ip"):
+                continue
+            for port, info in ports.items():
+                result.append((port, info["state"]))
 
         return result
 
-    def map_network(self, raw_host, pool_size=POOL_SIZE):
+    async def _scan_chunk(self, hosts, pool_size):
+        """
+        Ports are scanned as soon as the sweep finds each host, both take their
+        sockets from the same budget.
+        """
+        sockets = asyncio.Semaphore(socket_budget())
+        discovery = Discovery(concurrency=pool_size, sockets=sockets)
+        self._discovery = discovery
+        port_scanner = PortScanner(self.ports, sockets=sockets)
+
+        async for host, port, state in port_scanner.scan(discovery.sweep(hosts)):
+            self._add(host, port, state)
+
+    def _scan(self, hosts, pool_size):
+        started_at = time.monotonic()
+
+        for chunk in self._chunks(hosts):
+            if self.backend == NMAP_BACKEND:
+                hosts_up = Discovery(concurrency=pool_size).run(chunk)
+                for host, ports in pool.map(self._map_network_ports, hosts_up):
+                    for port, state in ports:
+                        self._add(host, port, state)
+            else:
+                asyncio.run(self._scan_chunk(chunk, pool_size))
+
+            with self._lock:
+                self.swept += len(chunk)
+                self._discovery = None
+
+        with self._lock:
+            self.inventory.end_cycle(hosts, started_at, time.monotonic())
+
+    def _get_targets(self, network, now):
+        """
+        Hosts to look at in this cycle, None when it is not time for one yet.
+        """
+        if self._cycle is not None and not self._cycle.done():
+            return None
+
+        if network != self.network:
+            self.network = network
+            self.swept_at = None
+            with self._lock:
+                self.inventory.clear()
+        elif self.scanned_at is not None and now - self.scanned_at < RESCAN_INTERVAL:
+            return None
+
+        self.scanned_at = now
+        is_sweep = self.swept_at is None or now - self.swept_at > SWEEP_INTERVAL
+        if is_sweep:
+            self.swept_at = now
+
+        with self._lock:
+            hosts = self.inventory.due(now)
+            if is_sweep:
+                hosts += [
+                    str(host)
+                    for host in network.hosts()
+                    if str(host) not in self.inventory
+                ]
+
+        return hosts
+
+    def _start(self, hosts, pool_size):
+        with self._lock:
+            self.total = len(hosts)
+            self.swept = 0
+
+        self._cycle = cycles.submit(self._scan, hosts, pool_size)
+        self._cycle.add_done_callback(self._on_cycle_done)
+
+    @staticmethod
+    def _on_cycle_done(cycle):
+        if not cycle.cancelled() and cycle.exception() is not None:
+            print(f"Scan failed: {cycle.exception()!r}")
+
+    def map_network(self, raw_host, sub_mask=None, pool_size=POOL_SIZE):
         header = ["host", "port", "state"]
-        self.counter += 1
-
-        if self.counter == 0 or self.counter < 10:
-            return self.scanned
-        elif self.counter % INTERVAL_UPDATE == 0 or self.counter == 10:
-            hosts = self._map_network(raw_host, pool_size)
-            for host in hosts:
-                ports = self._map_network_ports(host)
-                for port in ports:
-                    self.scanned.append([host, port[0], port[1]])
-
-        return [header] + self.scanned
+
+        if raw_host is not None:
+            # Anyone can ask the server for a scan, it must not scan for them
+            if not self.is_local(raw_host, sub_mask):
+                raise ValueError(f"{raw_host}/{sub_mask} is not a local network")
+
+            network = self.get_network(raw_host, sub_mask)
+            hosts = self._get_targets(network, time.monotonic())
+            if hosts:
+                self._start(hosts, pool_size)
+
+        with self._lock:
+            return [header] + self.inventory.rows()
+
+    def progress(self, raw_host=None, sub_mask=None):
+        with self._lock:
+            if not self.total:
+                return 0
+
+            # Hosts already probed in the chunk being swept count too
+            swept = self.swept + (self._discovery.probed if self._discovery else 0)
+            return swept / self.total
+
+    def hosts_found(self, raw_host=None, sub_mask=None):
+        with self._lock:
+            return len(self.inventory)
+
+    def added(self, raw_host=None, sub_mask=None):
+        with self._lock:
+            return list(self.inventory.added)
+
+    def removed(self, raw_host=None, sub_mask=None):
+        with self._lock:
+            return list(self.inventory.removed)
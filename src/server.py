@@ -1,29 +1,425 @@
-import socket
+import asyncio
+import os
+import random
+import time
 from datetime import datetime
+from functools import partial
 
+import wire
+from cache import SnapshotCache
+from constants import Screens
 from factories import CommandsFactory
 from helpers import decode_message, encode_message
+from transport import (
+    HOST,
+    KEEPALIVE_INTERVAL,
+    PORT,
+    SOCKET_PATH,
+    TCP,
+    TRANSPORT,
+    UDP,
+    Reassembler,
+    check_transport,
+    fragment,
+    frame,
+    read_frame,
+)
+from workers import pool
 
-BUFFER_SIZE = 1024
-PORT = 9991
+# Requests of the same command served at once, the others wait for a slot. Slow
+# commands get few slots so they can not take every worker.
+CONCURRENCY = {
+    Screens.SCANNER: 1,
+    Screens.PROCESS: 2,
+    Screens.DATA_USAGE: 2,
+    Screens.SYSTEM: 2,
+}
+DEFAULT_CONCURRENCY = 8
 
-s = socket.socket(type=socket.SOCK_DGRAM)
-s.bind(("0.0.0.0", PORT))
+# Subscriptions the client did not renew for this long are dropped
+SUBSCRIPTION_TTL = 3 * KEEPALIVE_INTERVAL
+MIN_PUSH_INTERVAL = 0.1
+# Pushes between two with whole answers, and pushes kept to be acknowledged
+KEYFRAME_INTERVAL = 30
+SENT_HISTORY = 16
+# Subscriptions kept for one peer and for all of them, the others are refused
+PEER_SUBSCRIPTIONS = 32
+MAX_SUBSCRIPTIONS = 1024
 
 
-if __name__ == "__main__":
-    print("Starting server...")
-    while True:
-        raw_data, addr = s.recvfrom(BUFFER_SIZE)
+class RequestHandler:
+    """
+    Runs the commands of every request on the worker pool, so a slow command
+    never blocks the other clients, whatever transport brought the request.
+    Answers still fresh in the cache are sent without collecting them again.
+    """
+
+    def __init__(self, concurrency=None, cache=None):
+        self.concurrency = concurrency or CONCURRENCY
+        self.cache = cache if cache is not None else SnapshotCache()
+        self.subscriptions = Subscriptions(self)
+
+        self._limits = {}
+
+    def _limit(self, command):
+        limit = self._limits.get(command)
+        if limit is None:
+            slots = self.concurrency.get(command, DEFAULT_CONCURRENCY)
+            limit = self._limits[command] = asyncio.Semaphore(slots)
+        return limit
+
+    async def execute(self, command, args):
+        key = self.cache.key(command, args)
+        return await self.cache.get(key, lambda: self._collect(command, args))
+
+    async def _collect(self, command, args):
+        strategy = next(CommandsFactory.build([(command, args)]), None)
+        if strategy is None:
+            return None
+
+        async with self._limit(command):
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(pool.executor(), strategy.execute)
+            except Exception as e:
+                print(f"{command} failed: {e!r}")
+                return None
+
+    async def answer(self, data, addr):
+        """
+        The encoded response to the request in `data`, None when it is invalid.
+        """
+        try:
+            request_id, commands = decode_message(data)
+        except Exception as e:
+            print(f"Invalid request from {addr}: {e!r}")
+            return None
+
+        answers = await self.collect(commands)
+        print(f"answered {addr} - {datetime.now()}...")
+
+        return encode_message(answers, request_id)
+
+    async def collect(self, commands):
+        answers = await asyncio.gather(
+            *(self.execute(command, args) for command, args in commands)
+        )
+        return list(answers)
+
+    async def handle(self, data, peer, send):
+        """
+        Answers a request or updates a subscription of `peer`, every message
+        for it goes through `send`.
+        """
+        try:
+            kind = wire.message_kind(data)
+        except ValueError as e:
+            print(f"Invalid message from {peer}: {e!r}")
+            return
+
+        if kind == wire.SUBSCRIBE:
+            try:
+                subscription_id, commands, interval = wire.decode_subscribe(data)
+            except ValueError as e:
+                print(f"Invalid subscription from {peer}: {e!r}")
+                return
+
+            self.subscriptions.update(peer, subscription_id, commands, interval, send)
+            return
+
+        if kind == wire.ACK:
+            try:
+                subscription_id, sequence = wire.decode_ack(data)
+            except ValueError as e:
+                print(f"Invalid ack from {peer}: {e!r}")
+                return
+
+            self.subscriptions.ack(peer, subscription_id, sequence)
+            return
+
+        response = await self.answer(data, peer)
+        if response is not None:
+            send(response)
+
+
+class Subscription:
+    __slots__ = (
+        "commands",
+        "interval",
+        "send",
+        "renewed_at",
+        "task",
+        "wake",
+        "sequence",
+        "sent",
+        "acked",
+        "resend",
+        "since_keyframe",
+        "confirmed",
+        "unconfirmed",
+    )
+
+    def __init__(self, commands, interval, send, now):
+        self.commands = commands
+        self.interval = interval
+        self.send = send
+        self.renewed_at = now
+        self.task = None
+        self.wake = asyncio.Event()
+
+        # Answers of the last pushes by sequence, and the last one the client
+        # acknowledged, which the next pushes are encoded against
+        self.sequence = random.randrange(1 << 30)
+        self.sent = {}
+        self.acked = None
+        self.resend = False
+        self.since_keyframe = 0
+
+        # Sequences start at random, so only a peer that receives the pushes
+        # can acknowledge one. Until it does, a single push answers each time
+        # it subscribes, or anyone could have pushes sent to a forged address.
+        self.confirmed = False
+        self.unconfirmed = 0
+
+    @property
+    def may_push(self):
+        return self.confirmed or not self.unconfirmed
+
+    def encode(self, subscription_id, answers):
+        self.sequence += 1
+        self.sent[self.sequence] = answers
+        while len(self.sent) > SENT_HISTORY:
+            del self.sent[next(iter(self.sent))]
+
+        if not self.confirmed:
+            self.unconfirmed += 1
+
+        if self.acked is None or self.since_keyframe >= KEYFRAME_INTERVAL:
+            self.since_keyframe = 0
+            return wire.encode_push(subscription_id, self.sequence, answers)
+
+        self.since_keyframe += 1
+        base_sequence, base = self.acked
+        return wire.encode_push(
+            subscription_id, self.sequence, answers, base, base_sequence
+        )
+
+    def ack(self, sequence):
+        if not sequence and self.confirmed:
+            # The client lost the base of a push, it gets whole answers again
+            self.acked = None
+            self.resend = True
+            self.wake.set()
+            return
+
+        answers = self.sent.get(sequence)
+        if answers is None:
+            return
+
+        self.confirmed = True
+        if self.acked is None or sequence > self.acked[0]:
+            self.acked = (sequence, answers)
+
+
+class Subscriptions:
+    """
+    Pushes the answers of every subscription on its own schedule, only when
+    they changed or the client has not heard from the server for a while.
+    Pushes only carry what changed since the answers the client acknowledged
+    last, with whole answers every KEYFRAME_INTERVAL pushes or when the client
+    asks for them. Subscriptions not renewed within `ttl` seconds are dropped,
+    so the server stops working for clients that went away, and a peer gets
+    further pushes only once it acknowledged one.
+    """
+
+    def __init__(self, handler, ttl=SUBSCRIPTION_TTL):
+        self.handler = handler
+        self.ttl = ttl
+
+        self.subscriptions = {}
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def update(self, peer, subscription_id, commands, interval, send):
+        key = (peer, subscription_id)
+        subscription = self.subscriptions.get(key)
+        now = time.monotonic()
 
-        if raw_data:
-            raw_commands = decode_message(raw_data)
+        if interval <= 0:
+            self.cancel(key)
+            return
 
-            commands = CommandsFactory.build(raw_commands)
-            answers = []
-            for command in commands:
-                answers.append(command.execute())
+        interval = max(interval, MIN_PUSH_INTERVAL)
+        if subscription is not None:
+            if subscription.commands == commands:
+                subscription.interval = interval
+                subscription.send = send
+                subscription.renewed_at = now
+                if not subscription.confirmed:
+                    # The push it answered may have been lost
+                    subscription.unconfirmed = 0
+                    subscription.resend = True
+                    subscription.wake.set()
+                return
 
-            s.sendto(encode_message(answers), addr)
+            self.cancel(key)
 
-        print(f"awaiting - {datetime.now()}...")
+        if not self._admit(peer):
+            print(f"Subscription {subscription_id} of {peer} refused: too many")
+            return
+
+        subscription = self.subscriptions[key] = Subscription(
+            commands, interval, send, now
+        )
+        subscription.task = asyncio.ensure_future(self._push(key, subscription))
+
+    def _admit(self, peer):
+        if len(self.subscriptions) >= MAX_SUBSCRIPTIONS:
+            return False
+
+        owned = sum(1 for key in self.subscriptions if key[0] == peer)
+        return owned < PEER_SUBSCRIPTIONS
+
+    def cancel(self, key):
+        subscription = self.subscriptions.pop(key, None)
+        if subscription is not None:
+            subscription.task.cancel()
+
+    def ack(self, peer, subscription_id, sequence):
+        subscription = self.subscriptions.get((peer, subscription_id))
+        if subscription is not None:
+            subscription.ack(sequence)
+
+    def drop(self, peer):
+        for key in [key for key in self.subscriptions if key[0] == peer]:
+            self.cancel(key)
+
+    async def _push(self, key, subscription):
+        _, subscription_id = key
+        last_answers, pushed_at = None, None
+        try:
+            while time.monotonic() - subscription.renewed_at < self.ttl:
+                answers = await self.handler.collect(subscription.commands)
+
+                now = time.monotonic()
+                if subscription.may_push and (
+                    subscription.resend
+                    or answers != last_answers
+                    or pushed_at is None
+                    or now - pushed_at >= KEEPALIVE_INTERVAL
+                ):
+                    subscription.send(subscription.encode(subscription_id, answers))
+                    subscription.resend = False
+                    last_answers, pushed_at = answers, now
+
+                try:
+                    await asyncio.wait_for(
+                        subscription.wake.wait(), subscription.interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                subscription.wake.clear()
+        except (ConnectionError, OSError) as e:
+            print(f"Subscription of {key[0]} lost: {e!r}")
+        finally:
+            if self.subscriptions.get(key) is subscription:
+                del self.subscriptions[key]
+
+
+class WatcherServerProtocol(asyncio.DatagramProtocol):
+    """
+    Every message is handled on its own task once all its fragments arrived,
+    and the answers go back fragmented.
+    """
+
+    def __init__(self, handler=None):
+        self.handler = handler or RequestHandler()
+        self.transport = None
+
+        self._reassembler = Reassembler()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            message = self._reassembler.feed(data, addr)
+        except ValueError as e:
+            print(f"Invalid datagram from {addr}: {e!r}")
+            return
+
+        if message is not None:
+            asyncio.ensure_future(
+                self.handler.handle(message, addr, partial(self.send, addr))
+            )
+
+    def send(self, addr, message):
+        for datagram in fragment(message):
+            self.transport.sendto(datagram, addr)
+
+
+class WatcherStreamServer:
+    """
+    Serves the messages of every connection in order until the client closes
+    it, each message prefixed by its length. Its subscriptions end with it.
+    """
+
+    def __init__(self, handler=None):
+        self.handler = handler or RequestHandler()
+
+    async def __call__(self, reader, writer):
+        addr = writer.get_extra_info("peername") or "unix client"
+
+        def send(message):
+            if writer.is_closing():
+                raise ConnectionResetError("Connection closed")
+            writer.write(frame(message))
+
+        try:
+            while True:
+                data = await read_frame(reader)
+                if data is None:
+                    break
+
+                await self.handler.handle(data, writer, send)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            print(f"Connection with {addr} lost: {e!r}")
+        finally:
+            self.handler.subscriptions.drop(writer)
+            writer.close()
+
+
+async def _start(transport, host, port, path, handler):
+    loop = asyncio.get_running_loop()
+
+    if transport == UDP:
+        endpoint, _ = await loop.create_datagram_endpoint(
+            lambda: WatcherServerProtocol(handler), local_addr=(host, port)
+        )
+        return endpoint
+
+    if transport == TCP:
+        return await asyncio.start_server(WatcherStreamServer(handler), host, port)
+
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(WatcherStreamServer(handler), path)
+
+
+async def serve(
+    host=HOST, port=PORT, transport=TRANSPORT, path=SOCKET_PATH, handler=None
+):
+    handler = handler or RequestHandler()
+    server = await _start(check_transport(transport), host, port, path, handler)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    print(f"Starting server over {TRANSPORT}...")
+    asyncio.run(serve())
@@ -1,15 +1,42 @@
+import heapq
+import json
 import os
 import sched
 import socket
+import threading
 import time
-from operator import itemgetter
+from array import array
+from itertools import islice
 
 import cpuinfo
 import netifaces
 import psutil
 from texttable import Texttable
 
-from helpers import clean_terminal, prettify, scheduler_timer
+from helpers import clean_terminal, prettify, prettify_rate, scheduler_timer
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+CPU_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "watcher", "cpu.json")
+
+PROCESS_ATTRS = ["pid", "num_threads", "name", "memory_percent", "cpu_percent"]
+TOP_PROCESSES = 10
+
+CONNECTIONS_KIND = "inet"
+CONNECTIONS_LIMIT = 10
+
+NETWORK_COUNTERS = (
+    "bytes_sent",
+    "bytes_recv",
+    "packets_sent",
+    "packets_recv",
+    "errin",
+    "errout",
+    "dropin",
+    "dropout",
+)
+# Rates taken closer than this are too noisy, the last ones are kept instead
+MIN_RATE_INTERVAL = 0.5
+INTERFACES_LIMIT = 15
 
 
 class Publisher:
@@ -28,12 +55,80 @@ class Publisher:
 
 
 class CPUService:
+    """
+    Static fields come from `cpuinfo`, which takes around a second, so they are
+    probed once per boot and shared by every instance. Only the usage and the
+    current frequency are sampled live.
+    """
+
+    _static_info = None
+    _lock = threading.Lock()
+
     def __init__(self):
-        self.info = cpuinfo.get_cpu_info()
+        self.info = self.get_static_info()
+
+    @staticmethod
+    def _boot_id():
+        try:
+            with open(BOOT_ID_PATH) as f:
+                return f.read().strip()
+        except OSError:
+            return str(psutil.boot_time())
+
+    @staticmethod
+    def _probe():
+        info = cpuinfo.get_cpu_info()
+        frequency = psutil.cpu_freq()
+
+        return {
+            "brand": info.get("brand_raw"),
+            "arch": info.get("arch"),
+            "bits": info.get("bits"),
+            "count": psutil.cpu_count(),
+            "logical_count": psutil.cpu_count(logical=True),
+            "max_frequency": frequency.max if frequency else None,
+        }
+
+    @staticmethod
+    def _load(boot_id):
+        try:
+            with open(CPU_CACHE_PATH) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if cached.get("boot_id") != boot_id:
+            return None
+        return cached.get("info")
+
+    @staticmethod
+    def _dump(boot_id, info):
+        try:
+            os.makedirs(os.path.dirname(CPU_CACHE_PATH), exist_ok=True)
+            tmp_path = f"{CPU_CACHE_PATH}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump({"boot_id": boot_id, "info": info}, f)
+            os.replace(tmp_path, CPU_CACHE_PATH)
+        except OSError:
+            pass
+
+    @classmethod
+    def get_static_info(cls):
+        with cls._lock:
+            if cls._static_info is None:
+                boot_id = cls._boot_id()
+                info = cls._load(boot_id)
+                if info is None:
+                    info = cls._probe()
+                    cls._dump(boot_id, info)
+
+                cls._static_info = info
+
+        return cls._static_info
 
     @property
     def brand(self):
-        return self.info.get("brand_raw")
+        return self.info.get("brand")
 
     @property
     def arch(self):
@@ -45,15 +140,15 @@ class CPUService:
 
     @property
     def count(self):
-        return psutil.cpu_count()
+        return self.info.get("count")
 
     @property
     def logical_count(self):
-        return psutil.cpu_count(logical=True)
+        return self.info.get("logical_count")
 
     @property
     def max_frequency(self):
-        return psutil.cpu_freq().max
+        return self.info.get("max_frequency")
 
     @property
     def current_frequency(self):
@@ -79,7 +174,9 @@ class DataUsageService:
         self.interface_name = self.network_service.interface_name
         self._net = psutil.net_io_counters(pernic=True).get(self.interface_name)
 
-        self.process_service = ProcessService()
+    @property
+    def interfaces(self):
+        return self.network_service.interfaces
 
     def __getattr__(self, item):
         return getattr(self, item, 0)
@@ -162,44 +259,172 @@ class DataUsageService:
             "remote address",
             "remote port",
         ]
+        connections = self.get_connections()
+
         pid_connections = []
+        for conn in connections:
+            pid_connections.append(
+                [
+                    conn.pid,
+                    self.get_type(conn.type),
+                    self.get_family(conn.family),
+                    conn.status,
+                    self.get_address(conn.laddr),
+                    self.get_port(conn.laddr),
+                    self.get_address(conn.raddr),
+                    self.get_port(conn.raddr),
+                ]
+            )
 
-        pids = self.process_service.get_pids()
-        for pid in pids:
-            try:
-                conns = psutil.Process(pid.pid).connections()
-            except (psutil.AccessDenied, psutil.NoSuchProcess):
-                continue
+        return [header] + pid_connections
 
-            for conn in conns:
-                pid_connections.append(
+    @staticmethod
+    def get_connections(kind=CONNECTIONS_KIND, limit=CONNECTIONS_LIMIT, status=None):
+        """
+        A single system-wide read, psutil joins the sockets to their pids through
+        the inode index instead of asking every process for its connections.
+        """
+        try:
+            connections = psutil.net_connections(kind=kind)
+        except psutil.AccessDenied:
+            return []
+
+        connections = (
+            conn
+            for conn in connections
+            if conn.pid is not None and (status is None or conn.status == status)
+        )
+        return list(islice(connections, limit))
+
+
+class NetworkThroughput:
+    """
+    Samples the counters of every interface at once and keeps the last counters
+    and the per second rates since the previous sample. Both live in flat
+    arrays with one row of `NETWORK_COUNTERS` per interface.
+    """
+
+    def __init__(self, counters=NETWORK_COUNTERS):
+        self.counters = counters
+        self.interfaces = {}
+        self.sampled_at = None
+
+        self._values = array("Q")
+        self._rates = array("d")
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.sampled_at if self.sampled_at is not None else 0
+            if self.sampled_at is not None and elapsed < MIN_RATE_INTERVAL:
+                return
+
+            stats = psutil.net_io_counters(pernic=True)
+            width = len(self.counters)
+
+            # Rebuilt on every sample, so interfaces that went away are dropped
+            interfaces = {}
+            values = array("Q", bytes(8 * width * len(stats)))
+            rates = array("d", bytes(8 * width * len(stats)))
+
+            for idx, (name, nic) in enumerate(stats.items()):
+                interfaces[name] = idx
+                previous_idx = self.interfaces.get(name)
+
+                for column, counter in enumerate(self.counters):
+                    value = getattr(nic, counter)
+                    values[idx * width + column] = value
+                    if previous_idx is None or not elapsed:
+                        continue
+
+                    previous = self._values[previous_idx * width + column]
+                    # The counter restarts from 0 on wrap or when the nic resets
+                    delta = value - previous if value >= previous else value
+                    rates[idx * width + column] = delta / elapsed
+
+            self.interfaces, self._values, self._rates = interfaces, values, rates
+            self.sampled_at = now
+
+    def _interface_rates(self, idx):
+        width = len(self.counters)
+        return dict(zip(self.counters, self._rates[idx * width : (idx + 1) * width]))
+
+    def rates(self, name):
+        with self._lock:
+            return self._interface_rates(self.interfaces[name])
+
+    def table(self, limit=INTERFACES_LIMIT):
+        header = [
+            "interface",
+            "sent/s",
+            "recv/s",
+            "packets sent/s",
+            "packets recv/s",
+            "errors/s",
+            "drops/s",
+        ]
+        self.sample()
+
+        # Under the lock, so the rows come from the interfaces and rates of
+        # one sample even when another thread samples meanwhile
+        rows = []
+        with self._lock:
+            for name, idx in self.interfaces.items():
+                rates = self._interface_rates(idx)
+                rows.append(
                     [
-                        pid.pid,
-                        conn.type,
-                        self.get_family(conn.family),
-                        self.get_type(conn.status),
-                        self.get_address(conn.laddr),
-                        self.get_port(conn.laddr),
-                        self.get_address(conn.raddr),
-                        self.get_port(conn.raddr),
+                        name,
+                        rates["bytes_sent"],
+                        rates["bytes_recv"],
+                        round(rates["packets_sent"], 1),
+                        round(rates["packets_recv"], 1),
+                        round(rates["errin"] + rates["errout"], 1),
+                        round(rates["dropin"] + rates["dropout"], 1),
                     ]
                 )
 
-        return [header] + pid_connections[:10]
+        # Busiest interfaces first, hosts can have dozens of idle virtual ones
+        rows = heapq.nlargest(limit, rows, key=lambda row: row[1] + row[2])
+        for row in rows:
+            row[1], row[2] = prettify_rate(row[1]), prettify_rate(row[2])
+
+        return [header] + rows
 
 
 class NetworkService:
+    throughput = NetworkThroughput()
+
     def __init__(self):
         self.info = psutil.net_if_addrs()
         self.gateways = netifaces.gateways()
 
+    @staticmethod
+    def _ipv4(addresses):
+        return next((a for a in addresses if a.family == socket.AF_INET), None)
+
     @property
     def interface_name(self):
-        return list(self.info.keys())[1]
+        default = self.gateways.get("default", {}).get(netifaces.AF_INET)
+        if default and default[1] in self.info:
+            return default[1]
+
+        # Without a default route, the first interface that is not loopback
+        for name, addresses in self.info.items():
+            address = self._ipv4(addresses)
+            if address and not address.address.startswith("127."):
+                return name
+
+        return next(iter(self.info))
 
     @property
     def _interface(self):
-        return self.info.get(self.interface_name)[0]
+        addresses = self.info.get(self.interface_name)
+        return self._ipv4(addresses) or addresses[0]
+
+    @property
+    def interfaces(self):
+        return self.throughput.table()
 
     @property
     def ip(self):
@@ -256,39 +481,68 @@ class DiskService:
         return round(self.usage * 100, 2)
 
 
-class ProcessService:
-    def __init__(self):
-        self.info = psutil.pids()
+class ProcessTable:
+    """
+    Keeps a psutil.Process per pid between ticks, so `cpu_percent` has a
+    previous sample to compare with, and reads all the attributes of a process
+    in a single `oneshot` pass.
+    """
 
-    def get_pids(self):
-        pids = []
-        for pid in self.info:
-            try:
-                p = psutil.Process(pid)
-                pids.append(p)
-            except psutil.NoSuchProcess:
-                continue
-        return pids
+    def __init__(self, attrs=PROCESS_ATTRS):
+        self.attrs = attrs
+        self.processes = {}
+
+        self._lock = threading.Lock()
+
+    def _get_process(self, pid):
+        process = self.processes.get(pid)
+        # is_running also compares the creation time, so a reused pid is a miss
+        if process is None or not process.is_running():
+            process = psutil.Process(pid)
+        return process
+
+    def sample(self):
+        rows = []
+
+        with self._lock:
+            processes = {}
+            for pid in psutil.pids():
+                try:
+                    process = self._get_process(pid)
+                    rows.append(process.as_dict(self.attrs, ad_value=None))
+                except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                    continue
+
+                processes[pid] = process
+
+            self.processes = processes
+
+        return rows
+
+    def top(self, n=TOP_PROCESSES, key="memory_percent"):
+        return heapq.nlargest(n, self.sample(), key=lambda row: row[key] or 0)
+
+
+class ProcessService:
+    table = ProcessTable()
 
     @property
     def pids(self):
         header = ["pid", "threads", "name", "memory(%)", "cpu(%)"]
 
-        raw_pids = self.get_pids()
-
         pids = []
-        for p in raw_pids:
+        for p in self.table.top():
             pids.append(
                 [
-                    p.pid,
-                    p.num_threads(),
-                    p.name(),
-                    round(p.memory_percent(), 1),
-                    p.cpu_percent(),
+                    p["pid"],
+                    p["num_threads"],
+                    p["name"],
+                    round(p["memory_percent"] or 0, 1),
+                    p["cpu_percent"],
                 ]
             )
 
-        return [header] + sorted(pids, key=itemgetter(3), reverse=True)[:10]
+        return [header] + pids
 
 
 class SystemService:
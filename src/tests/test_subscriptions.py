@@ -0,0 +1,209 @@
+import pytest
+
+import wire
+from client import AsyncClient, Watched
+from constants import Screens
+from models import CPUModel, MemoryModel
+from server import KEYFRAME_INTERVAL, Subscription
+
+SUBSCRIPTION_ID = 3
+COMMANDS = ((Screens.MEMORY, ()), (Screens.CPU, ()))
+
+
+def _answers(step):
+    return [
+        MemoryModel(usage=step / 100, total=16.0, available=8.0, pretty_usage=step),
+        CPUModel(
+            usage_per_cpu=[step / 100, 0.5],
+            brand="Test CPU",
+            arch="X86_64",
+            bits=64,
+            count=2,
+            logical_count=2,
+            max_frequency=3000.0,
+            current_frequency=2000.0 + step,
+        ),
+    ]
+
+
+def _base_sequence(push):
+    return wire.decode_push(push, lambda subscription_id, sequence: None)[2]
+
+
+class Link:
+    """
+    A server subscription and the client watching it, with the pushes and the
+    acks between them delivered or dropped on demand.
+    """
+
+    def __init__(self):
+        self.subscription = Subscription(COMMANDS, 1, None, 0)
+        self.client = AsyncClient()
+        self.watched = Watched(SUBSCRIPTION_ID, COMMANDS, 1, 0)
+        self.client._by_id[SUBSCRIPTION_ID] = self.watched
+
+        self.acks = []
+        self.client._send = self.acks.append
+
+    def push(self, answers, deliver=True):
+        push = self.subscription.encode(SUBSCRIPTION_ID, answers)
+        if deliver:
+            self.client.dispatch(push)
+        return push
+
+    def deliver_acks(self, deliver=True):
+        acks, self.acks[:] = list(self.acks), []
+        sequences = []
+        for ack in acks:
+            subscription_id, sequence = wire.decode_ack(ack)
+            assert subscription_id == SUBSCRIPTION_ID
+            sequences.append(sequence)
+            if deliver:
+                self.subscription.ack(sequence)
+        return sequences
+
+    def exchange(self, answers):
+        push = self.push(answers)
+        self.deliver_acks()
+        return push
+
+
+@pytest.fixture
+def link():
+    link = Link()
+    link.exchange(_answers(0))
+    return link
+
+
+def test_first_push_is_whole_and_confirms():
+    link = Link()
+
+    push = link.push(_answers(0))
+
+    assert _base_sequence(push) == 0
+    assert link.watched.answers == _answers(0)
+    assert not link.subscription.confirmed
+    assert link.deliver_acks() == [link.subscription.sequence]
+    assert link.subscription.confirmed
+    assert link.subscription.acked == (link.subscription.sequence, _answers(0))
+
+
+def test_pushes_are_deltas_once_acked(link):
+    acked = link.subscription.sequence
+
+    push = link.exchange(_answers(1))
+
+    assert _base_sequence(push) == acked
+    assert link.watched.answers == _answers(1)
+    assert link.watched.sequence == link.subscription.sequence
+
+
+def test_dropped_pushes(link):
+    acked = link.subscription.sequence
+    link.push(_answers(1), deliver=False)
+    link.push(_answers(2), deliver=False)
+
+    # Still encoded against the last push acknowledged, which the client has
+    push = link.exchange(_answers(3))
+
+    assert _base_sequence(push) == acked
+    assert link.watched.answers == _answers(3)
+
+
+def test_dropped_acks(link):
+    acked = link.subscription.sequence
+    link.push(_answers(1))
+    link.deliver_acks(deliver=False)
+    link.push(_answers(2))
+    link.deliver_acks(deliver=False)
+
+    push = link.exchange(_answers(3))
+
+    assert _base_sequence(push) == acked
+    assert link.watched.answers == _answers(3)
+
+
+def test_reordered_pushes(link):
+    late = link.push(_answers(1), deliver=False)
+    link.exchange(_answers(2))
+
+    link.client.dispatch(late)
+
+    assert link.watched.answers == _answers(2)
+    assert link.deliver_acks() == []
+
+
+def test_lost_base_asks_for_whole_answers(link):
+    # The client forgot the answers the server encodes against
+    link.watched.snapshots.clear()
+
+    link.push(_answers(1))
+
+    assert link.watched.answers == _answers(0)
+    assert link.deliver_acks() == [0]
+    assert link.subscription.acked is None
+    assert link.subscription.resend
+    assert link.subscription.wake.is_set()
+
+    push = link.exchange(_answers(1))
+
+    assert _base_sequence(push) == 0
+    assert link.watched.answers == _answers(1)
+    assert link.subscription.acked == (link.subscription.sequence, _answers(1))
+
+
+def test_ack_zero_before_confirmation_is_ignored():
+    link = Link()
+    link.push(_answers(0), deliver=False)
+
+    link.subscription.ack(0)
+
+    assert not link.subscription.confirmed
+    assert not link.subscription.resend
+    assert not link.subscription.wake.is_set()
+
+
+def test_ack_of_unknown_sequence_is_ignored(link):
+    acked = link.subscription.acked
+
+    link.subscription.ack(link.subscription.sequence + 100)
+
+    assert link.subscription.acked == acked
+
+
+def test_server_restart(link):
+    link.exchange(_answers(1))
+
+    # The new server starts below the sequences the client has seen
+    link.subscription = Subscription(COMMANDS, 1, None, 0)
+    link.subscription.sequence = 0
+    push = link.exchange(_answers(2))
+
+    assert _base_sequence(push) == 0
+    assert link.watched.answers == _answers(2)
+    assert link.watched.sequence == 1
+    assert link.subscription.confirmed
+
+    push = link.exchange(_answers(3))
+
+    assert _base_sequence(push) == 1
+    assert link.watched.answers == _answers(3)
+
+
+def test_keyframe_interval(link):
+    bases = [_base_sequence(link.exchange(_answers(step))) for step in range(1, 100)]
+
+    whole = [step for step, base in enumerate(bases, 1) if not base]
+    assert whole == list(range(KEYFRAME_INTERVAL + 1, 100, KEYFRAME_INTERVAL + 1))
+    assert link.watched.answers == _answers(99)
+
+
+def test_keyframe_after_dropped_pushes(link):
+    for step in range(1, KEYFRAME_INTERVAL + 1):
+        link.push(_answers(step), deliver=False)
+
+    # Whole answers reach a client that missed every delta
+    push = link.exchange(_answers(KEYFRAME_INTERVAL + 1))
+
+    assert _base_sequence(push) == 0
+    assert link.watched.answers == _answers(KEYFRAME_INTERVAL + 1)
@@ -0,0 +1,202 @@
+import asyncio
+import random
+
+import pytest
+
+import transport
+from transport import (
+    FRAGMENT_HEADER,
+    FRAGMENT_SIZE,
+    LENGTH_HEADER,
+    MAX_MESSAGE_FRAGMENTS,
+    MAX_MESSAGE_SIZE,
+    Reassembler,
+    fragment,
+    frame,
+    read_frame,
+)
+
+MESSAGE = bytes(random.Random(0).getrandbits(8) for _ in range(5 * FRAGMENT_SIZE + 7))
+
+
+def _read(data, eof=True):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        if eof:
+            reader.feed_eof()
+        return await read_frame(reader)
+
+    return asyncio.run(read())
+
+
+def test_fragment_sizes():
+    datagrams = fragment(MESSAGE, message_id=7)
+    assert len(datagrams) == 6
+    assert all(len(d) <= FRAGMENT_HEADER.size + FRAGMENT_SIZE for d in datagrams)
+    assert [FRAGMENT_HEADER.unpack_from(d) for d in datagrams] == [
+        (7, index, 6) for index in range(6)
+    ]
+
+
+def test_fragment_empty():
+    assert Reassembler().feed(fragment(b"")[0]) == b""
+
+
+def test_fragment_too_large():
+    with pytest.raises(ValueError):
+        fragment(bytes(MAX_MESSAGE_SIZE + 1))
+
+
+def test_reassemble_in_order():
+    reassembler = Reassembler()
+    *first, last = fragment(MESSAGE)
+    assert [reassembler.feed(d) for d in first] == [None] * len(first)
+    assert reassembler.feed(last) == MESSAGE
+    assert not reassembler.pending
+    assert reassembler.pending_bytes == 0
+
+
+def test_reassemble_out_of_order():
+    reassembler = Reassembler()
+    datagrams = fragment(MESSAGE)
+    random.Random(1).shuffle(datagrams)
+    answers = [reassembler.feed(d) for d in datagrams]
+    assert answers[-1] == MESSAGE
+    assert answers[:-1] == [None] * (len(datagrams) - 1)
+
+
+def test_reassemble_duplicates():
+    reassembler = Reassembler()
+    datagrams = fragment(MESSAGE)
+    for datagram in datagrams[:-1]:
+        assert reassembler.feed(datagram) is None
+        assert reassembler.feed(datagram) is None
+    assert reassembler.pending_bytes == (len(datagrams) - 1) * FRAGMENT_SIZE
+
+    assert reassembler.feed(datagrams[-1]) == MESSAGE
+    # A late copy starts a new message, which is never completed
+    assert reassembler.feed(datagrams[0]) is None
+
+
+def test_reassemble_interleaved_sources():
+    reassembler = Reassembler()
+    first = fragment(MESSAGE, message_id=1)
+    second = fragment(MESSAGE[::-1], message_id=1)
+    for a, b in zip(first[:-1], second[:-1]):
+        assert reassembler.feed(a, "a") is None
+        assert reassembler.feed(b, "b") is None
+    assert reassembler.feed(second[-1], "b") == MESSAGE[::-1]
+    assert reassembler.feed(first[-1], "a") == MESSAGE
+
+
+def test_reassemble_expired(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(transport.time, "monotonic", lambda: now[0])
+
+    reassembler = Reassembler(timeout=5)
+    datagrams = fragment(MESSAGE)
+    assert reassembler.feed(datagrams[0]) is None
+
+    now[0] += 6
+    assert reassembler.feed(fragment(MESSAGE)[0]) is None
+    assert len(reassembler.pending) == 1
+    assert reassembler.pending_bytes == FRAGMENT_SIZE
+    # The rest of the expired message is not enough to complete it
+    assert [reassembler.feed(d) for d in datagrams[1:]] == [None] * 5
+
+
+def test_reassemble_max_pending():
+    reassembler = Reassembler(max_pending=2)
+    messages = [fragment(MESSAGE) for _ in range(3)]
+    for datagrams in messages:
+        assert reassembler.feed(datagrams[0]) is None
+    assert len(reassembler.pending) == 2
+
+    # The first one was dropped to make room for the last
+    assert reassembler.feed(messages[0][-1]) is None
+    for datagram in messages[2][1:-1]:
+        assert reassembler.feed(datagram) is None
+    assert reassembler.feed(messages[2][-1]) == MESSAGE
+
+
+def test_reassemble_max_pending_bytes():
+    reassembler = Reassembler(max_pending_bytes=4 * FRAGMENT_SIZE)
+    first, second = fragment(MESSAGE), fragment(MESSAGE)
+    for datagram in first[:3]:
+        reassembler.feed(datagram)
+    for datagram in second[:2]:
+        reassembler.feed(datagram)
+
+    # The oldest message was dropped to keep the newest
+    assert list(reassembler.pending) == [
+        (None, FRAGMENT_HEADER.unpack_from(second[0])[0])
+    ]
+    assert reassembler.pending_bytes == 2 * FRAGMENT_SIZE
+
+    # A message larger than all the room is dropped when it outgrows it
+    with pytest.raises(ValueError):
+        for datagram in second[2:]:
+            reassembler.feed(datagram)
+    assert not reassembler.pending
+    assert reassembler.pending_bytes == 0
+
+
+def test_reassemble_too_many_fragments():
+    datagram = FRAGMENT_HEADER.pack(1, 0, MAX_MESSAGE_FRAGMENTS + 1) + b"x"
+    with pytest.raises(ValueError):
+        Reassembler().feed(datagram)
+
+
+def test_reassemble_fragment_too_large():
+    datagram = FRAGMENT_HEADER.pack(1, 0, 2) + bytes(FRAGMENT_SIZE + 1)
+    with pytest.raises(ValueError):
+        Reassembler().feed(datagram)
+
+
+@pytest.mark.parametrize(
+    "datagram",
+    [
+        b"\x00" * (FRAGMENT_HEADER.size - 1),
+        FRAGMENT_HEADER.pack(1, 0, 0),
+        FRAGMENT_HEADER.pack(1, 3, 3),
+    ],
+    ids=["short", "no fragments", "index past count"],
+)
+def test_reassemble_invalid_header(datagram):
+    with pytest.raises(ValueError):
+        Reassembler().feed(datagram)
+
+
+def test_reassemble_count_changed():
+    reassembler = Reassembler()
+    reassembler.feed(FRAGMENT_HEADER.pack(1, 0, 3) + b"a")
+    with pytest.raises(ValueError):
+        reassembler.feed(FRAGMENT_HEADER.pack(1, 1, 4) + b"b")
+    assert not reassembler.pending
+    assert reassembler.pending_bytes == 0
+
+
+def test_read_frame():
+    assert _read(frame(MESSAGE) + frame(b"next")) == MESSAGE
+    assert _read(frame(b"")) == b""
+
+
+def test_read_frame_closed():
+    assert _read(b"") is None
+
+
+def test_read_frame_truncated():
+    with pytest.raises(asyncio.IncompleteReadError):
+        _read(frame(MESSAGE)[:-1])
+
+
+def test_read_frame_too_large():
+    # Refused from the header, before waiting for the body
+    with pytest.raises(ValueError):
+        _read(LENGTH_HEADER.pack(MAX_MESSAGE_SIZE + 1), eof=False)
+
+
+def test_frame_too_large():
+    with pytest.raises(ValueError):
+        frame(bytes(MAX_MESSAGE_SIZE + 1))
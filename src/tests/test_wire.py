@@ -0,0 +1,236 @@
+import random
+import struct
+
+import pytest
+
+import wire
+from constants import Screens
+from models import (
+    CPUModel,
+    DataUsageModel,
+    DiskModel,
+    FleetModel,
+    MemoryModel,
+    NetworkModel,
+    ProcessModel,
+    ScannerModel,
+    SystemModel,
+)
+
+CPU = CPUModel(
+    usage_per_cpu=[0.25, 0.5, 1.0, 0.0],
+    brand="Intel(R) Core(TM) i7-10750H CPU @ 2.60GHz",
+    arch="X86_64",
+    bits=64,
+    count=4,
+    logical_count=8,
+    max_frequency=5000.0,
+    current_frequency=2600.123456,
+)
+MEMORY = MemoryModel(usage=0.42, total=15.5, available=9.0, pretty_usage=42.0)
+DISK = DiskModel(usage="42%", total="512 GB", available="300 GB", pretty_usage="")
+NETWORK = NetworkModel(
+    ip="192.168.0.10",
+    interface_name="eth0",
+    gateway="192.168.0.1",
+    sub_mask="255.255.255.0",
+    interfaces=[wire.KNOWN_HEADERS[2]]
+    + [[f"veth{i}", "1.5 KB/s", "20.0 KB/s", 10.0, 12.5, 0.0, 0] for i in range(3)],
+)
+SCANNER = ScannerModel(
+    map_network=[["host", "port", "state"]]
+    + [[f"10.0.{i}.{i * 3}", 22, "open"] for i in range(40)],
+    progress=0.5,
+    hosts_found=40,
+    added=["10.0.1.3"],
+    removed=[],
+)
+PROCESS = ProcessModel(
+    pids=[["pid", "threads", "name", "memory(%)", "cpu(%)"]]
+    + [[i * 1000, i, f"process-é{i}", 1.25, None] for i in range(10)]
+)
+DATA_USAGE = DataUsageModel(
+    interface_name="eth0",
+    bytes_sent=1.25,
+    bytes_recv=12.5,
+    packets_sent=2**40,
+    packets_recv=-3,
+    dropin=0,
+    dropout=0,
+    errin=0,
+    errout=0,
+    pids_connections=[wire.KNOWN_HEADERS[1]]
+    + [
+        [i, "TCP", "IPv4", "ESTABLISHED", "192.168.0.10", 40000 + i, "::1", 443]
+        for i in range(5)
+    ],
+    interfaces=[],
+)
+SYSTEM = SystemModel(
+    dirs=[["name", "type", "nested"]]
+    + [[f"entry-{i}", "file", [True, False, {"a": 1}.get("a")]] for i in range(5)]
+)
+FLEET = FleetModel(
+    hosts=3,
+    answering=2,
+    cpu=[0.1, 0.2, 0.3],
+    memory=[0.5, 0.6, 0.7],
+    disk=[],
+    memory_total=64.0,
+    memory_available=32.0,
+    disk_total=0.0,
+    disk_available=0.0,
+    top_cpu=[["host", "cpu"], ["a", 0.5], ["b", 0.25]],
+    top_memory=[["host", "memory"]],
+    rows=[["host", "cpu", "memory"], ["a", 0.5, None], ["b", 0.25, 0.75]],
+)
+ANSWERS = [CPU, MEMORY, DISK, NETWORK, SCANNER, PROCESS, DATA_USAGE, SYSTEM, FLEET]
+
+
+def _no_base(subscription_id, sequence):
+    return None
+
+
+@pytest.mark.parametrize("answer", ANSWERS, ids=lambda answer: type(answer).__name__)
+def test_response_round_trip(answer):
+    encoded = wire.encode_response([answer, None], request_id=7)
+
+    assert wire.decode_response(encoded) == (7, [answer, None])
+
+
+def test_request_round_trip():
+    commands = [(Screens.CPU, ()), (Screens.SYSTEM, ("/tmp",)), (Screens.FLEET, ())]
+
+    request_id, decoded = wire.decode_request(wire.encode_request(commands, 3))
+
+    assert request_id == 3
+    assert decoded == commands
+
+
+def test_subscribe_round_trip():
+    commands = [(Screens.SCANNER, ())]
+
+    encoded = wire.encode_subscribe(5, commands, 1.5)
+
+    assert wire.decode_subscribe(encoded) == (5, commands, 1.5)
+
+
+def test_ack_round_trip():
+    assert wire.decode_ack(wire.encode_ack(5, 9)) == (5, 9)
+
+
+def test_push_round_trip():
+    encoded = wire.encode_push(5, 1, ANSWERS)
+
+    assert wire.decode_push(encoded, _no_base) == (5, 1, 0, ANSWERS)
+
+
+def test_push_delta_round_trip():
+    rows = SCANNER.map_network
+    new_scanner = ScannerModel(
+        map_network=rows[:10] + [["10.0.99.1", 80, "closed"]] + rows[11:],
+        progress=1.0,
+        hosts_found=SCANNER.hosts_found,
+        added=SCANNER.added,
+        removed=["10.0.1.3"],
+    )
+    shorter = ProcessModel(pids=PROCESS.pids[:4])
+    base = [SCANNER, PROCESS, MEMORY]
+    answers = [new_scanner, shorter, MEMORY]
+
+    encoded = wire.encode_push(5, 2, answers, base=base, base_sequence=1)
+    decoded = wire.decode_push(encoded, lambda *_: base)
+
+    assert decoded == (5, 2, 1, answers)
+    assert len(encoded) < len(wire.encode_push(5, 2, answers))
+
+
+def test_push_delta_without_base():
+    encoded = wire.encode_push(5, 2, [MEMORY], base=[MEMORY], base_sequence=1)
+
+    assert wire.decode_push(encoded, _no_base) == (5, 2, 1, None)
+
+
+def test_unsupported_version():
+    encoded = bytearray(wire.encode_response([MEMORY]))
+    encoded[0] = wire.VERSION + 1
+
+    with pytest.raises(ValueError, match="version"):
+        wire.decode_response(bytes(encoded))
+
+
+def test_unexpected_kind():
+    with pytest.raises(ValueError, match="kind"):
+        wire.decode_response(wire.encode_request([(Screens.CPU, ())]))
+
+
+@pytest.mark.parametrize("answer", ANSWERS, ids=lambda answer: type(answer).__name__)
+def test_truncated_response(answer):
+    encoded = wire.encode_response([answer])
+
+    for size in range(len(encoded)):
+        with pytest.raises(ValueError):
+            wire.decode_response(encoded[:size])
+
+
+def test_unknown_model():
+    encoded = bytearray(wire.encode_response([MEMORY]))
+    encoded[8] = len(wire.MODELS) + 1
+
+    with pytest.raises(ValueError):
+        wire.decode_response(bytes(encoded))
+
+
+def test_unknown_value_tag():
+    encoded = bytearray(wire.encode_response([MEMORY]))
+    encoded[9] = 0xEE
+
+    with pytest.raises(ValueError):
+        wire.decode_response(bytes(encoded))
+
+
+def test_huge_column_size():
+    header = struct.pack("!BBHI", wire.VERSION, wire.RESPONSE, 1, 0)
+    answer = bytes([wire.MODELS.index(SystemModel) + 1, wire.LIST])
+    encoded = header + answer + struct.pack("!I", 2**32 - 1) + bytes([wire.VALUES])
+
+    with pytest.raises(ValueError):
+        wire.decode_response(encoded)
+
+
+def test_huge_delta_size():
+    base = [PROCESS]
+    encoded = bytearray(wire.encode_push(5, 2, base, base=base, base_sequence=1))
+    # A delta announcing far more rows than the base and the changes hold
+    delta = bytes([wire.DELTA, wire.CHANGED_ROWS])
+    delta += struct.pack("!II", 2**32 - 1, 0) + bytes([wire.INT8])
+    delta += bytes([wire.LIST]) + struct.pack("!I", 1) + bytes([wire.VALUES])
+    delta += bytes([wire.NONE])
+    encoded = encoded[:16] + delta
+
+    with pytest.raises(ValueError):
+        wire.decode_push(bytes(encoded), lambda *_: base)
+
+
+def test_random_bytes():
+    rand = random.Random(0)
+    decoders = [
+        wire.decode_request,
+        wire.decode_response,
+        wire.decode_subscribe,
+        wire.decode_ack,
+        lambda data: wire.decode_push(data, _no_base),
+    ]
+    samples = [wire.encode_response(ANSWERS), wire.encode_push(5, 1, ANSWERS)]
+
+    for _ in range(2000):
+        data = bytearray(rand.choice(samples))
+        for _ in range(rand.randint(1, 8)):
+            data[rand.randrange(4, len(data))] = rand.randrange(256)
+        data[1] = rand.choice((wire.RESPONSE, wire.PUSH))
+
+        for decode in decoders:
+            try:
+                decode(bytes(data))
+            except ValueError:
+                pass
@@ -0,0 +1,200 @@
+"""
+Moves the encoded messages between the client and the server.
+
+UDP splits every message in fragments that fit a datagram, each one with the id
+of the message, its index and the number of fragments, so the receiver can put
+it back together. TCP and Unix sockets keep one connection open and prefix every
+message with its length.
+"""
+import itertools
+import os
+import struct
+import time
+
+UDP = "udp"
+TCP = "tcp"
+UNIX = "unix"
+TRANSPORTS = (UDP, TCP, UNIX)
+
+# Both ends pick the same one, by default from the environment
+TRANSPORT = os.environ.get("WATCHER_TRANSPORT", UDP)
+HOST = "0.0.0.0"
+PORT = 9991
+SOCKET_PATH = os.environ.get("WATCHER_SOCKET", "/tmp/watcher.sock")
+
+# Payload of a fragment, small enough to not be fragmented by IP on most links
+FRAGMENT_SIZE = 1200
+FRAGMENT_HEADER = struct.Struct("!IHH")
+DATAGRAM_SIZE = FRAGMENT_HEADER.size + FRAGMENT_SIZE
+MAX_FRAGMENTS = 0xFFFF
+# Messages missing fragments for this long are dropped
+REASSEMBLY_TIMEOUT = 5
+MAX_PENDING = 64
+
+LENGTH_HEADER = struct.Struct("!I")
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# Fragments of the largest message, and bytes of all messages waiting for some
+MAX_MESSAGE_FRAGMENTS = MAX_MESSAGE_SIZE // FRAGMENT_SIZE + 1
+MAX_PENDING_BYTES = 2 * MAX_MESSAGE_SIZE
+
+# Seconds between two renewals of a subscription by the client, the server also
+# pushes unchanged answers this often so the client knows it is alive
+KEEPALIVE_INTERVAL = 3
+
+_message_ids = itertools.count(1)
+
+
+def check_transport(transport):
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {transport}, use one of {TRANSPORTS}")
+    return transport
+
+
+def fragment(data, message_id=None, size=FRAGMENT_SIZE):
+    """
+    Splits `data` in datagrams of at most `size` bytes of payload.
+    """
+    if message_id is None:
+        message_id = next(_message_ids) & 0xFFFFFFFF
+
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {len(data)} bytes is too large")
+    chunks = [data[i : i + size] for i in range(0, len(data), size)] or [b""]
+    if len(chunks) > MAX_FRAGMENTS:
+        raise ValueError(f"Message of {len(data)} bytes is too large")
+
+    count = len(chunks)
+    return [
+        FRAGMENT_HEADER.pack(message_id, index, count) + chunk
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+class Reassembler:
+    """
+    Puts fragmented messages back together. Fragments may come out of order or
+    repeated, messages never completed are dropped after `timeout` seconds or
+    when more than `max_pending` are waiting, the oldest first. So are they
+    when their fragments hold more than `max_pending_bytes` together.
+    """
+
+    def __init__(
+        self,
+        timeout=REASSEMBLY_TIMEOUT,
+        max_pending=MAX_PENDING,
+        max_pending_bytes=MAX_PENDING_BYTES,
+    ):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+
+        self.pending = {}
+        self.pending_bytes = 0
+
+    def feed(self, datagram, source=None):
+        """
+        Returns the whole message once its last fragment arrives, None before.
+        """
+        if len(datagram) < FRAGMENT_HEADER.size:
+            raise ValueError("Datagram too short")
+
+        message_id, index, count = FRAGMENT_HEADER.unpack_from(datagram)
+        if not count or index >= count or count > MAX_MESSAGE_FRAGMENTS:
+            raise ValueError(f"Invalid fragment {index} of {count}")
+
+        chunk = datagram[FRAGMENT_HEADER.size :]
+        if len(chunk) > FRAGMENT_SIZE:
+            raise ValueError(f"Fragment of {len(chunk)} bytes is too large")
+        if count == 1:
+            return chunk
+
+        now = time.monotonic()
+        key = (source, message_id)
+        self._expire(now, keep=key)
+
+        started_at, chunks = self.pending.setdefault(key, (now, [None] * count))
+        if len(chunks) != count:
+            self._drop(key)
+            raise ValueError("Fragment count changed")
+
+        if chunks[index] is None:
+            chunks[index] = chunk
+            self.pending_bytes += len(chunk)
+            self._make_room(keep=key)
+        if any(c is None for c in chunks):
+            return None
+
+        self._drop(key)
+        return b"".join(chunks)
+
+    def _drop(self, key):
+        _, chunks = self.pending.pop(key)
+        self.pending_bytes -= sum(len(c) for c in chunks if c is not None)
+
+    def _expire(self, now, keep):
+        expired = [
+            key
+            for key, (started_at, _) in self.pending.items()
+            if now - started_at > self.timeout
+        ]
+        for key in expired:
+            self._drop(key)
+
+        while len(self.pending) >= self.max_pending and keep not in self.pending:
+            self._drop(next(iter(self.pending)))
+
+    def _make_room(self, keep):
+        """
+        Drops the oldest messages until the fragments waiting fit in
+        `max_pending_bytes`, and the one of `keep` too if it does not alone.
+        """
+        for key in [key for key in self.pending if key != keep]:
+            if self.pending_bytes <= self.max_pending_bytes:
+                return
+            self._drop(key)
+
+        if self.pending_bytes > self.max_pending_bytes:
+            self._drop(keep)
+            raise ValueError("Message too large to reassemble")
+
+
+def frame(data):
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {len(data)} bytes is too large")
+    return LENGTH_HEADER.pack(len(data)) + data
+
+
+def _check_length(size):
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {size} bytes is too large")
+    return size
+
+
+async def read_frame(reader):
+    """
+    Reads a message from an asyncio stream, None when the peer closed it.
+    """
+    try:
+        header = await reader.readexactly(LENGTH_HEADER.size)
+    except EOFError:
+        return None
+
+    (size,) = LENGTH_HEADER.unpack(header)
+    return await reader.readexactly(_check_length(size))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise ConnectionError("Connection closed by the server")
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b"".join(chunks)
+
+
+def recv_frame(sock):
+    (size,) = LENGTH_HEADER.unpack(_recv_exactly(sock, LENGTH_HEADER.size))
+    return _recv_exactly(sock, _check_length(size))
@@ -0,0 +1,740 @@
+"""
+Compact binary encoding of the requests and responses exchanged by the client
+and the server.
+
+Every message starts with a version byte and a kind byte. Models are written as
+their fields in declaration order, so no names go on the wire: the tag bytes of
+all the fields, their fixed-width payloads packed together, then the bytes of
+strings and tables. Tables are written column by column, each column packed as
+a single array when all its cells share a type, and the usual headers are sent
+as a one byte index.
+
+Ids of screens, models and headers are their position in the lists below, new
+entries must always be appended.
+"""
+import re
+import socket
+import struct
+from dataclasses import fields
+from functools import lru_cache
+from operator import attrgetter
+
+from constants import Screens
+from models import (
+    CPUModel,
+    DataUsageModel,
+    DiskModel,
+    FleetModel,
+    MemoryModel,
+    NetworkModel,
+    ProcessModel,
+    ScannerModel,
+    SystemModel,
+)
+
+VERSION = 4
+
+REQUEST = 1
+RESPONSE = 2
+SUBSCRIBE = 3
+PUSH = 4
+ACK = 5
+
+SCREENS = list(Screens)
+MODELS = [
+    CPUModel,
+    MemoryModel,
+    DiskModel,
+    NetworkModel,
+    ScannerModel,
+    ProcessModel,
+    DataUsageModel,
+    SystemModel,
+    FleetModel,
+]
+# Headers of the tables built by the services
+KNOWN_HEADERS = [
+    ["pid", "threads", "name", "memory(%)", "cpu(%)"],
+    [
+        "pid",
+        "type",
+        "family",
+        "status",
+        "local address",
+        "local port",
+        "remote address",
+        "remote port",
+    ],
+    [
+        "interface",
+        "sent/s",
+        "recv/s",
+        "packets sent/s",
+        "packets recv/s",
+        "errors/s",
+        "drops/s",
+    ],
+    ["host", "port", "state"],
+    ["name", "type"],
+    ["host", "cpu"],
+    ["host", "memory"],
+    [
+        "host",
+        "cpu",
+        "memory",
+        "disk",
+        "memory total",
+        "memory available",
+        "disk total",
+        "disk available",
+        "status",
+    ],
+]
+
+# Value tags
+NONE = 0
+FALSE = 1
+TRUE = 2
+INT8 = 3
+INT16 = 4
+INT32 = 5
+INT64 = 6
+FIXED = 7
+FLOAT = 8
+STR = 9
+LIST = 10
+TABLE = 11
+KNOWN_TABLE = 12
+
+# Column kinds, besides the integer ones which share the tags above
+FIXEDS = 13
+FLOATS = 14
+STRS = 15
+DICT = 16
+IPV4 = 17
+VALUES = 18
+
+INT_FORMATS = {INT8: "b", INT16: "h", INT32: "i", INT64: "q"}
+# Floats with up to FIXED_DIGITS decimals, which is how the services round them,
+# are sent as integers
+FIXED_DIGITS = 2
+FIXED_SCALE = 10**FIXED_DIGITS
+FIXED_LIMIT = (1 << 31) / FIXED_SCALE
+# Strings of a column are joined by it, columns holding it are sent as values
+SEPARATOR = "\0"
+
+# Fields of a pushed answer, compared to the acknowledged one
+DELTA = 0xFF
+SAME = 0
+CHANGED = 1
+CHANGED_ROWS = 2
+
+# Anything a malformed message can raise while it is decoded
+DECODE_ERRORS = (
+    struct.error,
+    IndexError,
+    KeyError,
+    TypeError,
+    OSError,
+    UnicodeDecodeError,
+    RecursionError,
+)
+
+_FIELDS = {model: tuple(field.name for field in fields(model)) for model in MODELS}
+_MODEL_IDS = {model: idx + 1 for idx, model in enumerate(MODELS)}
+_HEADER_IDS = {tuple(header): idx for idx, header in enumerate(KNOWN_HEADERS)}
+
+# Payload packed with the other fixed-width ones of a model, strings only have
+# their length there
+SCALAR_FORMATS = {**INT_FORMATS, FIXED: "i", FLOAT: "d", STR: "I"}
+# Dotted quads as inet_ntoa writes them, so they come back the same
+IPV4_OCTET = "(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+IPV4_ADDRESS = rf"{IPV4_OCTET}(?:\.{IPV4_OCTET}){{3}}"
+_IPV4_COLUMN = re.compile(rf"{IPV4_ADDRESS}(?:{SEPARATOR}{IPV4_ADDRESS})*")
+
+_is_bool = bool.__instancecheck__
+_is_int = int.__instancecheck__
+_is_list = list.__instancecheck__
+_is_str = str.__instancecheck__
+_scale = float(FIXED_SCALE).__mul__
+_unscale = float(FIXED_SCALE).__rtruediv__
+_format_ipv4 = "{}.{}.{}.{}".format
+
+
+def _getter(names):
+    getter = attrgetter(*names)
+    return getter if len(names) > 1 else lambda answer: (getter(answer),)
+
+
+_GETTERS = {model: _getter(names) for model, names in _FIELDS.items()}
+
+
+@lru_cache(maxsize=256)
+def _struct(fmt):
+    return struct.Struct(fmt)
+
+
+@lru_cache(maxsize=256)
+def _scalars_struct(tags):
+    """
+    The struct packing the fixed-width payloads of values with these `tags`.
+    """
+    return struct.Struct("!" + "".join(SCALAR_FORMATS.get(tag, "") for tag in tags))
+
+
+def _int_kind(low, high):
+    if -0x80 <= low and high < 0x80:
+        return INT8
+    if -0x8000 <= low and high < 0x8000:
+        return INT16
+    if -0x80000000 <= low and high < 0x80000000:
+        return INT32
+    if -0x8000000000000000 <= low and high < 0x8000000000000000:
+        return INT64
+    return None
+
+
+def _write_ints(out, values):
+    kind = _int_kind(min(values), max(values)) if values else INT8
+    out.append(kind)
+    out += _struct(f"!{len(values)}{INT_FORMATS[kind]}").pack(*values)
+
+
+def _write_strs(out, joined):
+    encoded = joined.encode()
+    out += struct.pack("!I", len(encoded))
+    out += encoded
+
+
+def _write_int_column(out, values):
+    if any(map(_is_bool, values)):
+        return False
+    try:
+        kind = _int_kind(min(values), max(values))
+        if kind is None:
+            return False
+        packed = _struct(f"!{len(values)}{INT_FORMATS[kind]}").pack(*values)
+    except (TypeError, struct.error):
+        # Not only integers
+        return False
+
+    out.append(kind)
+    out += packed
+    return True
+
+
+def _write_float_column(out, values):
+    if any(map(_is_int, values)):
+        return False
+    try:
+        low, high = min(values), max(values)
+        if -FIXED_LIMIT < low and high < FIXED_LIMIT:
+            scaled = list(map(round, map(_scale, values)))
+        else:
+            scaled = None
+        # Only values read back the same are sent as integers
+        if scaled is not None and list(map(_unscale, scaled)) == values:
+            packed = _struct(f"!{len(values)}i").pack(*scaled)
+            kind = FIXEDS
+        else:
+            packed = _struct(f"!{len(values)}d").pack(*values)
+            kind = FLOATS
+    except (TypeError, struct.error):
+        return False
+
+    out.append(kind)
+    out += packed
+    return True
+
+
+def _write_str_column(out, values):
+    try:
+        joined = SEPARATOR.join(values)
+    except TypeError:
+        return False
+    if joined.count(SEPARATOR) != len(values) - 1:
+        return False
+
+    unique = dict.fromkeys(values)
+    if len(unique) * 2 <= len(values):
+        # Statuses, families, states... are sent once and then by index
+        index = {value: idx for idx, value in enumerate(unique)}
+        out.append(DICT)
+        out += struct.pack("!I", len(unique))
+        _write_strs(out, SEPARATOR.join(unique))
+        _write_ints(out, list(map(index.__getitem__, values)))
+    elif _IPV4_COLUMN.fullmatch(joined):
+        out.append(IPV4)
+        out += b"".join(map(socket.inet_aton, values))
+    else:
+        out.append(STRS)
+        _write_strs(out, joined)
+    return True
+
+
+COLUMN_WRITERS = {int: _write_int_column, float: _write_float_column}
+
+
+def _write_column(out, values):
+    """
+    The column packed as a single array when its cells share a type, else as
+    separate values. The packing functions find out by failing.
+    """
+    if not values:
+        _write_ints(out, values)
+        return
+
+    first = type(values[0])
+    writer = _write_str_column if first is str else COLUMN_WRITERS.get(first)
+    if writer is not None and writer(out, values):
+        return
+
+    out.append(VALUES)
+    for value in values:
+        _write_value(out, value)
+
+
+def _is_table(value):
+    if not value or type(value[0]) is not list:
+        return False
+
+    return (
+        all(map(_is_list, value))
+        and len(set(map(len, value))) == 1
+        and all(map(_is_str, value[0]))
+    )
+
+
+def _write_body(out, value):
+    """
+    Writes the body of a list or a table and returns its tag.
+    """
+    value_type = type(value)
+
+    if value_type is list and _is_table(value):
+        header, rows = value[0], value[1:]
+        header_id = _HEADER_IDS.get(tuple(header))
+        if header_id is not None:
+            out.append(header_id)
+            tag = KNOWN_TABLE
+        else:
+            out.append(len(header))
+            _write_column(out, header)
+            tag = TABLE
+
+        out += struct.pack("!I", len(rows))
+        for column in zip(*rows) if rows else [()] * len(header):
+            _write_column(out, list(column))
+        return tag
+
+    if value_type in (list, tuple):
+        out += struct.pack("!I", len(value))
+        _write_column(out, list(value))
+        return LIST
+
+    raise TypeError(f"Can not encode {value_type.__name__}")
+
+
+def _write_values(out, values):
+    """
+    The tags of all the `values` first, then the fixed-width payloads packed in
+    a single call, then the bytes of the strings and the bodies of the lists
+    and tables. A single value comes out as its tag and payload.
+    """
+    tags = bytearray()
+    scalars = []
+    tail = bytearray()
+
+    for value in values:
+        value_type = type(value)
+        if value_type is str:
+            encoded = value.encode()
+            tags.append(STR)
+            scalars.append(len(encoded))
+            tail += encoded
+        elif value_type is float:
+            scaled = (
+                round(value * FIXED_SCALE) if -FIXED_LIMIT < value < FIXED_LIMIT else 0
+            )
+            if scaled / FIXED_SCALE == value:
+                tags.append(FIXED)
+                scalars.append(scaled)
+            else:
+                tags.append(FLOAT)
+                scalars.append(value)
+        elif value_type is int:
+            kind = _int_kind(value, value)
+            if kind is None:
+                raise OverflowError(f"Can not encode {value}, out of the int64 range")
+            tags.append(kind)
+            scalars.append(value)
+        elif value is None:
+            tags.append(NONE)
+        elif value_type is bool:
+            tags.append(TRUE if value else FALSE)
+        else:
+            tags.append(_write_body(tail, value))
+
+    out += tags
+    out += _scalars_struct(bytes(tags)).pack(*scalars)
+    out += tail
+
+
+def _write_value(out, value):
+    _write_values(out, (value,))
+
+
+class _Reader:
+    __slots__ = ("data", "offset")
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, fmt):
+        return self.unpack_struct(_struct(fmt))
+
+    def unpack_struct(self, unpacker):
+        values = unpacker.unpack_from(self.data, self.offset)
+        self.offset += unpacker.size
+        return values
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError("Truncated message")
+
+        chunk = self.data[self.offset : self.offset + size]
+        self.offset += size
+        return chunk
+
+    def byte(self):
+        if self.offset >= len(self.data):
+            raise ValueError("Truncated message")
+
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def strs(self, size):
+        chunk = str(self.read(self.unpack("!I")[0]), "utf-8")
+        values = chunk.split(SEPARATOR) if size else []
+        if len(values) != size:
+            raise ValueError("Column size mismatch")
+        return values
+
+    def column(self, size):
+        kind = self.byte()
+
+        if kind in INT_FORMATS:
+            return list(self.unpack(f"!{size}{INT_FORMATS[kind]}"))
+        if kind == FIXEDS:
+            return list(map(_unscale, self.unpack(f"!{size}i")))
+        if kind == FLOATS:
+            return list(self.unpack(f"!{size}d"))
+        if kind == STRS:
+            return self.strs(size)
+        if kind == DICT:
+            unique = self.strs(self.unpack("!I")[0])
+            return list(map(unique.__getitem__, self.column(size)))
+        if kind == IPV4:
+            octets = iter(bytes(self.read(4 * size)))
+            return list(map(_format_ipv4, octets, octets, octets, octets))
+        if kind == VALUES:
+            return [self.value() for _ in range(size)]
+
+        raise ValueError(f"Unknown column kind {kind}")
+
+    def table(self, header):
+        size = self.unpack("!I")[0]
+        columns = [self.column(size) for _ in header]
+        if not columns:
+            return [header]
+        return [header] + list(map(list, zip(*columns)))
+
+    def body(self, tag):
+        if tag == LIST:
+            return self.column(self.unpack("!I")[0])
+        if tag == KNOWN_TABLE:
+            return self.table(list(KNOWN_HEADERS[self.byte()]))
+        if tag == TABLE:
+            return self.table(self.column(self.byte()))
+
+        raise ValueError(f"Unknown value tag {tag}")
+
+    def values(self, count):
+        tags = bytes(self.read(count))
+        scalars = iter(self.unpack_struct(_scalars_struct(tags)))
+
+        values = []
+        for tag in tags:
+            if tag in INT_FORMATS or tag == FLOAT:
+                values.append(next(scalars))
+            elif tag == FIXED:
+                values.append(next(scalars) / FIXED_SCALE)
+            elif tag == STR:
+                values.append(str(self.read(next(scalars)), "utf-8"))
+            elif tag == NONE:
+                values.append(None)
+            elif tag in (TRUE, FALSE):
+                values.append(tag == TRUE)
+            else:
+                values.append(self.body(tag))
+        return values
+
+    def value(self):
+        return self.values(1)[0]
+
+
+def _header(kind, count):
+    return bytearray(struct.pack("!BBH", VERSION, kind, count))
+
+
+def _read_header(reader, kind):
+    version, message_kind, count = reader.unpack("!BBH")
+    if version != VERSION:
+        raise ValueError(f"Unsupported wire version {version}")
+    if message_kind != kind:
+        raise ValueError(f"Expected message kind {kind}, got {message_kind}")
+    return count
+
+
+def message_kind(data):
+    """
+    Kind of the message in `data`, to pick the decoder for it.
+    """
+    if len(data) < 2:
+        raise ValueError("Message too short")
+    if data[0] != VERSION:
+        raise ValueError(f"Unsupported wire version {data[0]}")
+    return data[1]
+
+
+def _write_commands(out, commands):
+    for command, args in commands:
+        out.append(SCREENS.index(Screens(command)))
+        _write_value(out, list(args or ()))
+
+
+def _read_commands(reader, count):
+    return [(SCREENS[reader.byte()], tuple(reader.value())) for _ in range(count)]
+
+
+def _write_answers(out, answers):
+    for answer in answers:
+        if answer is None:
+            out.append(0)
+            continue
+
+        model = type(answer)
+        out.append(_MODEL_IDS[model])
+        _write_values(out, _GETTERS[model](answer))
+
+
+def _read_answer(reader, model_id):
+    if not model_id:
+        return None
+
+    model = MODELS[model_id - 1]
+    return model(*reader.values(len(_FIELDS[model])))
+
+
+def _read_answers(reader, count):
+    return [_read_answer(reader, reader.byte()) for _ in range(count)]
+
+
+def encode_request(commands, request_id=0):
+    """
+    Asks for the answers of `commands`, the response carries `request_id` back.
+    """
+    out = _header(REQUEST, len(commands))
+    out += struct.pack("!I", request_id)
+    _write_commands(out, commands)
+    return bytes(out)
+
+
+def decode_request(data):
+    """
+    Returns the request id and the commands of a request.
+    """
+    try:
+        reader = _Reader(data)
+        count = _read_header(reader, REQUEST)
+        (request_id,) = reader.unpack("!I")
+        return request_id, _read_commands(reader, count)
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Invalid request: {e}") from e
+
+
+def encode_response(answers, request_id=0):
+    out = _header(RESPONSE, len(answers))
+    out += struct.pack("!I", request_id)
+    _write_answers(out, answers)
+    return bytes(out)
+
+
+def decode_response(data):
+    """
+    Returns the request id and the answers of a response.
+    """
+    try:
+        reader = _Reader(data)
+        count = _read_header(reader, RESPONSE)
+        (request_id,) = reader.unpack("!I")
+        return request_id, _read_answers(reader, count)
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Invalid response: {e}") from e
+
+
+def encode_subscribe(subscription_id, commands, interval):
+    """
+    Asks for the answers of `commands` every `interval` seconds, sent again to
+    keep the subscription alive. An interval of 0 cancels it.
+    """
+    out = _header(SUBSCRIBE, len(commands))
+    out += struct.pack("!II", subscription_id, round(interval * 1000))
+    _write_commands(out, commands)
+    return bytes(out)
+
+
+def decode_subscribe(data):
+    try:
+        reader = _Reader(data)
+        count = _read_header(reader, SUBSCRIBE)
+        subscription_id, interval = reader.unpack("!II")
+        return subscription_id, _read_commands(reader, count), interval / 1000
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Invalid subscription: {e}") from e
+
+
+def _diff_rows(old, new):
+    """
+    Indexes of the rows of the `new` table that are not in `old` at the same
+    place, None when it is not worth sending them instead of the table.
+    """
+    if not (_is_table(old) and _is_table(new)) or old[0] != new[0]:
+        return None
+
+    changed = [
+        idx for idx in range(1, len(new)) if idx >= len(old) or old[idx] != new[idx]
+    ]
+    if len(changed) * 2 > len(new):
+        return None
+    return changed
+
+
+def _write_delta(out, base, answer):
+    if base is None or answer is None or type(base) is not type(answer):
+        _write_answers(out, [answer])
+        return
+
+    out.append(DELTA)
+    for name in _FIELDS[type(answer)]:
+        old, new = getattr(base, name), getattr(answer, name)
+        if old == new:
+            out.append(SAME)
+            continue
+
+        changed = _diff_rows(old, new) if type(new) is list else None
+        if changed is None:
+            out.append(CHANGED)
+            _write_value(out, new)
+            continue
+
+        out.append(CHANGED_ROWS)
+        out += struct.pack("!II", len(new), len(changed))
+        _write_column(out, changed)
+        _write_value(out, [new[0]] + [new[idx] for idx in changed])
+
+
+def _read_delta(reader, base):
+    model_id = reader.byte()
+    if model_id != DELTA:
+        return _read_answer(reader, model_id)
+
+    model = type(base)
+    values = []
+    for name in _FIELDS[model]:
+        old = getattr(base, name)
+        change = reader.byte()
+
+        if change == SAME:
+            values.append(old)
+        elif change == CHANGED:
+            values.append(reader.value())
+        elif change == CHANGED_ROWS:
+            size, count = reader.unpack("!II")
+            changed = reader.column(count)
+            rows = reader.value()[1:]
+            if len(rows) != count:
+                raise ValueError("Row count mismatch")
+            if size > len(old) + count:
+                raise ValueError("Missing rows")
+
+            table = old[:size] + [None] * (size - len(old))
+            for idx, row in zip(changed, rows):
+                table[idx] = row
+            if None in table:
+                raise ValueError("Missing rows")
+            values.append(table)
+        else:
+            raise ValueError(f"Unknown change {change}")
+
+    return model(*values)
+
+
+def encode_push(subscription_id, sequence, answers, base=None, base_sequence=0):
+    """
+    Answers of a subscription, as the changes since the `base` answers the
+    client acknowledged as `base_sequence`, or whole when there is no base.
+    """
+    out = _header(PUSH, len(answers))
+    out += struct.pack("!III", subscription_id, sequence, base_sequence)
+    if base is None or not base_sequence:
+        _write_answers(out, answers)
+    else:
+        for old, answer in zip(base, answers):
+            _write_delta(out, old, answer)
+
+    return bytes(out)
+
+
+def decode_push(data, get_base):
+    """
+    Returns the subscription id, the sequence, the base sequence and the
+    answers of a push, the answers are None when `get_base(subscription_id,
+    sequence)` does not have the base they were encoded against.
+    """
+    try:
+        reader = _Reader(data)
+        count = _read_header(reader, PUSH)
+        subscription_id, sequence, base_sequence = reader.unpack("!III")
+        if not base_sequence:
+            answers = _read_answers(reader, count)
+            return subscription_id, sequence, base_sequence, answers
+
+        base = get_base(subscription_id, base_sequence)
+        if base is None or len(base) != count:
+            return subscription_id, sequence, base_sequence, None
+
+        answers = [_read_delta(reader, old) for old in base]
+        return subscription_id, sequence, base_sequence, answers
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Invalid push: {e}") from e
+
+
+def encode_ack(subscription_id, sequence):
+    """
+    Acknowledges the push `sequence`, 0 asks for whole answers again.
+    """
+    out = _header(ACK, 0)
+    out += struct.pack("!II", subscription_id, sequence)
+    return bytes(out)
+
+
+def decode_ack(data):
+    try:
+        reader = _Reader(data)
+        _read_header(reader, ACK)
+        return reader.unpack("!II")
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Invalid ack: {e}") from e
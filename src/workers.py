@@ -0,0 +1,71 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+THREAD_BACKEND = "thread"
+PROCESS_BACKEND = "process"
+
+THREAD_WORKERS = 32
+PROCESS_WORKERS = os.cpu_count() or 1
+
+
+class WorkerPool:
+    """
+    Long lived executors shared by the scans and other bulk jobs, so repeated
+    jobs do not pay for starting workers. Each task picks its backend: threads
+    for I/O bound work, processes for CPU bound and picklable work.
+    """
+
+    def __init__(self, thread_workers=THREAD_WORKERS, process_workers=PROCESS_WORKERS):
+        self.workers = {
+            THREAD_BACKEND: thread_workers,
+            PROCESS_BACKEND: process_workers,
+        }
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def executor(self, backend=THREAD_BACKEND):
+        """
+        The executor of the backend, started on first use.
+        """
+        with self._lock:
+            executor = self._executors.get(backend)
+            if executor is None:
+                if backend == THREAD_BACKEND:
+                    executor = ThreadPoolExecutor(
+                        self.workers[backend], thread_name_prefix="worker"
+                    )
+                elif backend == PROCESS_BACKEND:
+                    executor = ProcessPoolExecutor(self.workers[backend])
+                else:
+                    raise ValueError(f"Unknown backend: {backend}")
+
+                self._executors[backend] = executor
+
+        return executor
+
+    def submit(self, fn, *args, backend=THREAD_BACKEND, **kwargs):
+        return self.executor(backend).submit(fn, *args, **kwargs)
+
+    def map(self, fn, jobs, backend=THREAD_BACKEND):
+        """
+        Yields `(job, result)` as each job completes. Jobs still pending are
+        cancelled when the caller stops iterating.
+        """
+        futures = {self.submit(fn, job, backend=backend): job for job in jobs}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executors, self._executors = self._executors, {}
+
+        for executor in executors.values():
+            executor.shutdown(wait=wait)
+
+
+pool = WorkerPool()